@@ -23,12 +23,18 @@ def create_app(config_object):
     app = connexion.App(__name__, specification_dir='./')
     app.app.config.from_object(config_object)
 
+    from . import commands
     from .models import db
+    from .storage import UploadRequest
 
     db.init_app(app.app)
     Migrate(app.app, db)
+    commands.init_app(app.app)
 
     app.add_api('labapp_api.yml')
+    from .labapp_api import check_content_length
+    app.app.before_request(check_content_length)
     app.app.json_encoder = FlaskJSONEncoder
+    app.app.request_class = UploadRequest
 
     return app.app
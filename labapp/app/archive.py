@@ -0,0 +1,113 @@
+import json
+import tarfile
+import time
+import zipfile
+
+from app.storage import CHUNK_SIZE
+
+
+class ArchiveBuffer:
+    """Write-only file-like object, that collects archive bytes until they
+    are drained by response generator.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def read_chunks(path):
+    with open(str(path), 'rb') as f:
+        yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+
+
+def archive_entries(records):
+    """Yields name, path and stat of every uploaded record file, followed by
+    manifest describing archived records.
+    """
+    manifest = []
+    for record in records:
+        if not record.is_uploaded():
+            continue
+        path = record.filepath
+        # FLAC files are archived as they are stored
+        name = "{}/{}{}".format(record.series_uid, record.uid,
+                                '.flac' if path.suffix == '.flac' else '.wav')
+        yield name, path, path.stat()
+        manifest.append(dict(record.to_dict(), file=name))
+    data = json.dumps(manifest, default=str, indent=2).encode()
+    yield 'manifest.json', data, None
+
+
+def stream_tar(records):
+    """Generates uncompressed tar archive of record files, reading them
+    chunk by chunk.
+    """
+    written = 0
+    for name, content, stat in archive_entries(records):
+        info = tarfile.TarInfo(name)
+        info.mode = 0o644
+        if stat is None:
+            info.size, info.mtime = len(content), time.time()
+        else:
+            info.size, info.mtime = stat.st_size, stat.st_mtime
+        header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+        yield header
+        size = 0
+        for chunk in read_chunks(content) if stat else [content]:
+            chunk = chunk[:info.size - size]
+            size += len(chunk)
+            yield chunk
+        if size < info.size:
+            # file was truncated while being sent, keep archive consistent
+            yield bytes(info.size - size)
+        blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+        if remainder:
+            yield bytes(tarfile.BLOCKSIZE - remainder)
+            blocks += 1
+        written += len(header) + blocks * tarfile.BLOCKSIZE
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(written + end) % tarfile.RECORDSIZE
+    yield bytes(end)
+
+
+def stream_zip(records):
+    """Generates zip archive of record files with stored (uncompressed)
+    entries. Sizes and checksums are written after entries' data, so files
+    are read only once.
+    """
+    buffer = ArchiveBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for name, content, stat in archive_entries(records):
+            mtime = time.time() if stat is None else stat.st_mtime
+            info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = len(content) if stat is None else stat.st_size
+            with archive.open(info, 'w') as entry:
+                for chunk in read_chunks(content) if stat else [content]:
+                    entry.write(chunk)
+                    yield buffer.drain()
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+ARCHIVE_FORMATS = {
+    'tar': (stream_tar, 'application/x-tar'),
+    'zip': (stream_zip, 'application/zip'),
+}
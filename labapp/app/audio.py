@@ -0,0 +1,569 @@
+import struct
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:  # analysis of audio data is optional
+    np = None
+try:
+    import soundfile
+except (ImportError, OSError):  # FLAC storage is optional
+    soundfile = None
+
+BLOCK_FRAMES = 64 * 1024
+# subtypes of PCM WAV, that FLAC stores losslessly, and their sample widths
+SAMPLE_WIDTHS = {'PCM_16': 2, 'PCM_24': 3}
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# sample sizes supported by format
+SAMPLE_BITS = {
+    WAVE_FORMAT_PCM: (8, 16, 24, 32),
+    WAVE_FORMAT_IEEE_FLOAT: (32, 64),
+}
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class WavHeader(namedtuple('WavHeader', [
+    'format_tag', 'channels', 'samplerate', 'bits_per_sample', 'block_align',
+    'data_offset', 'data_size'
+])):
+
+    @property
+    def frames(self):
+        return self.data_size // self.block_align
+
+
+def parse_wav_header(data):
+    """Parses RIFF, fmt and data chunk headers from beginning of WAV file.
+    Returns WavHeader, or None if more data is needed. Raises ValueError if
+    data is not a PCM or float WAV file.
+    """
+    if len(data) < 12:
+        return None
+    riff, _, wave = struct.unpack_from('<4sI4s', data)
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise ValueError("File is not a RIFF WAVE file")
+    offset = 12
+    fmt = None
+    while len(data) >= offset + 8:
+        chunk_id, chunk_size = struct.unpack_from('<4sI', data, offset)
+        offset += 8
+        if chunk_id == b'data':
+            if fmt is None:
+                raise ValueError("WAV file has no fmt chunk before data")
+            return WavHeader(*fmt, data_offset=offset, data_size=chunk_size)
+        if chunk_id == b'fmt ':
+            if chunk_size < 16:
+                raise ValueError("WAV file has invalid fmt chunk")
+            if len(data) < offset + min(chunk_size, 26):
+                return None
+            format_tag, channels, samplerate, _, block_align, bits = \
+                struct.unpack_from('<HHIIHH', data, offset)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 26:
+                # first two bytes of sub format GUID hold the format tag
+                format_tag, = struct.unpack_from('<H', data, offset + 24)
+            if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+                raise ValueError(
+                    "WAV file has unsupported format {:#06x}".format(
+                        format_tag)
+                )
+            if bits not in SAMPLE_BITS[format_tag]:
+                raise ValueError("WAV file has unsupported {} bits samples".
+                                 format(bits))
+            if not channels or not samplerate or not block_align or \
+                    block_align != channels * bits // 8:
+                raise ValueError("WAV file has invalid fmt chunk")
+            fmt = (format_tag, channels, samplerate, bits, block_align)
+        offset += chunk_size + (chunk_size & 1)
+    return None
+
+
+class WavHeaderParser:
+    """Parses WAV header from chunks of file passing through it, keeping
+    only bytes preceding audio data.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.header = None
+        self.error = None
+
+    def feed(self, data):
+        if self.header is not None or self.error is not None:
+            return
+        self.buffer += data[:MAX_HEADER_SIZE - len(self.buffer)]
+        try:
+            self.header = parse_wav_header(self.buffer)
+        except ValueError as ex:
+            self.error = str(ex)
+        if self.header is not None:
+            self.buffer = None
+        elif len(self.buffer) >= MAX_HEADER_SIZE:
+            self.error = "WAV file has no data chunk within first {} bytes".\
+                format(MAX_HEADER_SIZE)
+
+    def result(self):
+        """Returns parsed header. Raises ValueError if file is not valid WAV
+        file or ended before audio data.
+        """
+        if self.error is not None:
+            raise ValueError(self.error)
+        if self.header is None:
+            raise ValueError("WAV file header is truncated")
+        return self.header
+
+
+def check_wav(parser, size, parameters, frames_tolerance=0):
+    """Checks parsed WAV header and total file size against recording
+    parameters of series. Returns header, raises ValueError on mismatch.
+    """
+    header = parser.result()
+    if header.data_size % header.block_align:
+        raise ValueError("WAV data length is not multiple of frame size")
+    if size < header.data_offset + header.data_size:
+        raise ValueError("WAV file is truncated, {} of {} data bytes sent".
+                         format(size - header.data_offset, header.data_size))
+    if parameters is None:
+        return header
+    if header.samplerate != parameters.samplerate:
+        raise ValueError("WAV samplerate {} does not match series samplerate"
+                         " {}".format(header.samplerate,
+                                      parameters.samplerate))
+    if header.channels != parameters.channels:
+        raise ValueError("WAV has {} channels, series records {}".format(
+            header.channels, parameters.channels))
+    expected = int(round(parameters.duration * parameters.samplerate))
+    if abs(header.frames - expected) > frames_tolerance:
+        raise ValueError("WAV has {} frames, series duration implies {}".
+                         format(header.frames, expected))
+    return header
+
+
+def flac_available():
+    return soundfile is not None and 'FLAC' in soundfile.available_formats()
+
+
+def analysis_available():
+    return np is not None
+
+
+def read_wav_header(path):
+    with open(str(path), 'rb') as f:
+        parser = WavHeaderParser()
+        parser.feed(f.read(MAX_HEADER_SIZE))
+        return parser.result()
+
+
+def wav_memmap(path, header):
+    """Returns read-only memory map of audio data of WAV file, shaped
+    (frames, channels), or (frames, channels, 3) bytes for 24 bit samples.
+    """
+    shape = (header.frames, header.channels)
+    if header.format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        dtype = '<f{}'.format(header.block_align // header.channels)
+    elif header.bits_per_sample <= 8:
+        dtype = 'u1'
+    elif header.bits_per_sample == 24:
+        dtype, shape = 'u1', shape + (3,)
+    else:
+        dtype = '<i{}'.format(header.block_align // header.channels)
+    return np.memmap(str(path), dtype=dtype, mode='r',
+                     offset=header.data_offset, shape=shape)
+
+
+def to_float(samples, header):
+    """Converts samples read from WAV memory map to float32 in [-1, 1]."""
+    if header.format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        return samples.astype(np.float32)
+    if header.bits_per_sample <= 8:
+        return (samples.astype(np.float32) - 128) / 128
+    if header.bits_per_sample == 24:
+        samples = samples.astype(np.int32)
+        samples = samples[..., 0] | samples[..., 1] << 8 | \
+            samples[..., 2] << 16
+        samples = np.where(samples & 0x800000, samples - 0x1000000, samples)
+    return samples.astype(np.float32) / 2 ** (header.bits_per_sample - 1)
+
+
+def read_blocks(path, block_frames=BLOCK_FRAMES):
+    """Yields samplerate of WAV or FLAC file at given path followed by
+    blocks of its samples as float32 arrays shaped (frames, channels).
+    """
+    if str(path).endswith('.flac'):
+        with soundfile.SoundFile(str(path)) as flac:
+            yield flac.samplerate
+            yield from flac.blocks(block_frames, dtype='float32',
+                                   always_2d=True)
+        return
+    header = read_wav_header(path)
+    samples = wav_memmap(path, header)
+    yield header.samplerate
+    for start in range(0, header.frames, block_frames):
+        yield to_float(samples[start:start + block_frames], header)
+
+
+def read_frames(path, frames, dtype):
+    """Reads first frames of audio file at given path as array of given
+    dtype (int16 or float32) shaped (frames, channels). Shorter file is
+    padded with silence.
+    """
+    blocks = read_blocks(path)
+    next(blocks)
+    parts, count = [], 0
+    for block in blocks:
+        parts.append(block[:frames - count])
+        count += len(parts[-1])
+        if count == frames:
+            break
+    blocks.close()
+    samples = np.concatenate(parts) if parts else np.zeros((0, 1))
+    samples = np.pad(samples, ((0, frames - count), (0, 0)))
+    if np.dtype(dtype).kind == 'i':
+        samples = np.clip(np.round(samples * 32768), -32768, 32767)
+    return samples.astype(dtype)
+
+
+PEAKS_MAGIC = b'PEAK'
+PEAKS_HEADER = struct.Struct('<4sHHIQII')
+# finest level of envelope holds minimum and maximum of every 256 frames,
+# each coarser one of 4 peaks of previous level
+PEAKS_BLOCK = 256
+PEAKS_FACTOR = 4
+
+
+def compute_peaks(path):
+    """Computes min/max envelope of audio file, mixed over channels, at
+    multiple resolutions. Returns samplerate, number of frames and list of
+    (mins, maxs) int16 arrays, finest level first.
+    """
+    blocks = read_blocks(path, PEAKS_BLOCK * 1024)
+    samplerate = next(blocks)
+    frames = 0
+    mins, maxs = [], []
+    for block in blocks:
+        starts = np.arange(0, len(block), PEAKS_BLOCK)
+        mins.append(np.minimum.reduceat(block.min(axis=1), starts))
+        maxs.append(np.maximum.reduceat(block.max(axis=1), starts))
+        frames += len(block)
+    level = (np.concatenate(mins or [np.zeros(0, np.float32)]),
+             np.concatenate(maxs or [np.zeros(0, np.float32)]))
+    levels = [level]
+    while len(level[0]) > PEAKS_FACTOR:
+        starts = np.arange(0, len(level[0]), PEAKS_FACTOR)
+        level = (np.minimum.reduceat(level[0], starts),
+                 np.maximum.reduceat(level[1], starts))
+        levels.append(level)
+    return samplerate, frames, [
+        tuple(np.clip(np.round(peaks * 32768), -32768, 32767).astype('<i2')
+              for peaks in level)
+        for level in levels
+    ]
+
+
+def write_peaks(path, samplerate, frames, levels):
+    """Writes envelope as header, counts of peaks of every level and
+    interleaved min/max int16 pairs of every level, finest first.
+    """
+    with open(str(path), 'wb') as f:
+        f.write(PEAKS_HEADER.pack(PEAKS_MAGIC, 1, len(levels), samplerate,
+                                  frames, PEAKS_BLOCK, PEAKS_FACTOR))
+        f.write(struct.pack('<{}I'.format(len(levels)),
+                            *[len(mins) for mins, _ in levels]))
+        for mins, maxs in levels:
+            f.write(np.stack([mins, maxs], axis=1).tobytes())
+
+
+def read_peaks(path, width):
+    """Reads envelope of at most width peaks from peaks file, taking the
+    coarsest level having at least width peaks and merging its neighbouring
+    peaks. Returns dict describing envelope.
+    """
+    data = np.fromfile(str(path), dtype=np.uint8)
+    magic, _, count, samplerate, frames, block, factor = \
+        PEAKS_HEADER.unpack_from(data)
+    if magic != PEAKS_MAGIC:
+        raise ValueError("File is not a peaks file")
+    offset = PEAKS_HEADER.size + 4 * count
+    counts = struct.unpack_from('<{}I'.format(count), data,
+                                PEAKS_HEADER.size)
+    levels = []
+    for n in counts:
+        levels.append(np.frombuffer(data, '<i2', 2 * n, offset).reshape(n, 2))
+        offset += 4 * n
+    level, samples_per_peak = levels[0], block
+    for coarser in levels[1:]:
+        if len(coarser) < width:
+            break
+        level, samples_per_peak = coarser, samples_per_peak * factor
+    if len(level) > width:
+        starts = np.linspace(0, len(level), width, endpoint=False).\
+            astype(int)
+        samples_per_peak *= len(level) / width
+        level = np.stack([np.minimum.reduceat(level[:, 0], starts),
+                          np.maximum.reduceat(level[:, 1], starts)], axis=1)
+    return {
+        'samplerate': samplerate,
+        'frames': frames,
+        'samples_per_peak': samples_per_peak,
+        'min': level[:, 0].tolist(),
+        'max': level[:, 1].tolist()
+    }
+
+
+FEATURE_KINDS = ('stft', 'log-mel')
+# part of configuration hash, bumped when features computation changes
+FEATURES_VERSION = 1
+# number of STFT frames transformed at once, bounds memory of spectra
+FEATURES_BATCH = 1024
+
+
+def mel_filterbank(samplerate, n_fft, n_mels):
+    """Returns triangular filters spaced evenly on mel scale (HTK formula)
+    between 0 Hz and Nyquist frequency, shaped (n_mels, n_fft // 2 + 1).
+    """
+    def to_mel(hz):
+        return 2595 * np.log10(1 + hz / 700)
+
+    def to_hz(mel):
+        return 700 * (10 ** (mel / 2595) - 1)
+
+    bins = np.fft.rfftfreq(n_fft, 1 / samplerate)
+    edges = to_hz(np.linspace(0, to_mel(samplerate / 2), n_mels + 2))
+    lower, center, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    rising = (bins - lower) / (center - lower)
+    falling = (upper - bins) / (upper - center)
+    return np.maximum(0, np.minimum(rising, falling)).astype(np.float32)
+
+
+def compute_features(path, kind, n_fft, hop_length, n_mels=None):
+    """Computes spectral features of audio file mixed down to mono: STFT
+    magnitudes or log-mel spectrogram in dB. Returns shape (time, bins) of
+    float32 features with row of every hop_length frames, and generator of
+    their consecutive batches of rows.
+    """
+    blocks = read_blocks(path)
+    samplerate = next(blocks)
+    signal = np.concatenate([block.mean(axis=1) for block in blocks] +
+                            [np.zeros(0, np.float32)])
+    if len(signal) < n_fft:
+        signal = np.pad(signal, (0, n_fft - len(signal)))
+    # overlapping frames as view of signal, one every hop_length samples
+    step = signal.strides[0]
+    frames = np.lib.stride_tricks.as_strided(
+        signal, shape=(1 + (len(signal) - n_fft) // hop_length, n_fft),
+        strides=(step * hop_length, step), writeable=False
+    )
+    # periodic Hann window
+    window = np.hanning(n_fft + 1)[:-1].astype(np.float32)
+    if kind == 'log-mel':
+        filters = mel_filterbank(samplerate, n_fft, n_mels).T
+
+    def batches():
+        for start in range(0, len(frames), FEATURES_BATCH):
+            spectrum = np.abs(np.fft.rfft(
+                frames[start:start + FEATURES_BATCH] * window, axis=1
+            ))
+            if kind == 'log-mel':
+                spectrum = 10 * np.log10(np.maximum(spectrum ** 2 @ filters,
+                                                    1e-10))
+            yield spectrum.astype(np.float32)
+
+    bins = n_mels if kind == 'log-mel' else n_fft // 2 + 1
+    return (len(frames), bins), batches()
+
+
+def write_features(path, shape, batches):
+    """Writes batches of features into .npy file, which can be memory
+    mapped, without holding all of them in memory.
+    """
+    features = np.lib.format.open_memmap(str(path), mode='w+',
+                                         dtype=np.float32, shape=shape)
+    start = 0
+    for batch in batches:
+        features[start:start + len(batch)] = batch
+        start += len(batch)
+    features.flush()
+    del features
+
+
+def wav_header(frames, samplerate, channels, sampwidth):
+    """Returns canonical 44 bytes header of PCM WAV file."""
+    data_size = frames * channels * sampwidth
+    block_align = channels * sampwidth
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, samplerate, samplerate * block_align,
+        block_align, sampwidth * 8,
+        b'data', data_size
+    )
+
+
+def can_encode_flac(path):
+    """Tells whether WAV file at given path may be stored as FLAC without
+    losing anything.
+    """
+    try:
+        info = soundfile.info(str(path))
+    except RuntimeError:
+        return False
+    return info.format == 'WAV' and info.subtype in SAMPLE_WIDTHS
+
+
+def encode_flac(source, target):
+    """Encodes WAV file at source path into FLAC file at target path, block
+    by block.
+    """
+    with soundfile.SoundFile(str(source)) as wav:
+        with soundfile.SoundFile(str(target), 'w', wav.samplerate,
+                                 wav.channels, wav.subtype,
+                                 format='FLAC') as flac:
+            for block in wav.blocks(BLOCK_FRAMES, dtype='int32',
+                                    always_2d=True):
+                flac.write(block)
+
+
+def pcm_bytes(block, sampwidth):
+    """Returns little endian PCM bytes of block of int32 samples."""
+    if sampwidth == 2:
+        return (block >> 16).astype('<i2').tobytes()
+    # 24 bit samples are top three bytes of left justified int32 samples
+    return block.astype('<i4').view(np.uint8).reshape(-1, 4)[:, 1:].tobytes()
+
+
+def split_wav(path):
+    """Returns bytes of WAV file at given path preceding its samples and
+    bytes following them, which hold all its chunks other than samples.
+    """
+    header = read_wav_header(path)
+    with open(str(path), 'rb') as f:
+        head = f.read(header.data_offset)
+        f.seek(header.data_offset + header.frames * header.block_align)
+        return head, f.read()
+
+
+def write_riff(path, head, tail):
+    """Writes bytes surrounding samples of WAV file, as returned by
+    split_wav, into file.
+    """
+    with open(str(path), 'wb') as f:
+        f.write(struct.pack('<I', len(head)) + head + tail)
+
+
+def read_riff(path):
+    """Returns bytes surrounding samples of WAV file written by write_riff,
+    or None if there is no such file.
+    """
+    try:
+        with open(str(path), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    size, = struct.unpack_from('<I', data)
+    return data[4:4 + size], data[4 + size:]
+
+
+def decoded_wav_length(path, riff=None):
+    info = soundfile.info(str(path))
+    length = 44 if riff is None else len(riff[0]) + len(riff[1])
+    return length + info.frames * info.channels * SAMPLE_WIDTHS[info.subtype]
+
+
+def decode_flac(path, riff=None):
+    """Generates WAV file decoded from FLAC file at given path, block by
+    block. Samples are surrounded by given bytes of original WAV file, as
+    returned by split_wav, or by canonical header.
+    """
+    with soundfile.SoundFile(str(path)) as flac:
+        sampwidth = SAMPLE_WIDTHS[flac.subtype]
+        if riff is None:
+            riff = wav_header(flac.frames, flac.samplerate, flac.channels,
+                              sampwidth), b''
+        yield riff[0]
+        for block in flac.blocks(BLOCK_FRAMES, dtype='int32',
+                                 always_2d=True):
+            yield pcm_bytes(block, sampwidth)
+        if riff[1]:
+            yield riff[1]
+
+
+def silence(frames, block_align):
+    """Yields bytes of given number of silent PCM frames, block by block."""
+    for offset in range(0, frames, BLOCK_FRAMES):
+        yield bytes(min(BLOCK_FRAMES, frames - offset) * block_align)
+
+
+def read_pcm(path, start, frames, channels, sampwidth):
+    """Yields PCM bytes of given sample width of at most given number of
+    frames of audio file, beginning with start frame. WAV files are memory
+    mapped, so only requested part is read; their samples are passed as
+    they are, if they already have requested format. Files having other
+    number of channels yield nothing.
+    """
+    if str(path).endswith('.flac'):
+        with soundfile.SoundFile(str(path)) as flac:
+            if flac.channels != channels or start >= flac.frames:
+                return
+            flac.seek(start)
+            for block in flac.blocks(BLOCK_FRAMES,
+                                     frames=min(frames, flac.frames - start),
+                                     dtype='int32', always_2d=True):
+                yield pcm_bytes(block, sampwidth)
+        return
+    header = read_wav_header(path)
+    if header.channels != channels:
+        return
+    samples = wav_memmap(path, header)[start:start + frames]
+    native = header.format_tag == WAVE_FORMAT_PCM and \
+        header.bits_per_sample == 8 * sampwidth
+    for offset in range(0, len(samples), BLOCK_FRAMES):
+        block = samples[offset:offset + BLOCK_FRAMES]
+        if native:
+            yield block.tobytes()
+            continue
+        block = to_float(block, header).astype(np.float64) * 2 ** 31
+        yield pcm_bytes(
+            np.clip(np.round(block), -2 ** 31, 2 ** 31 - 1).astype(np.int32),
+            sampwidth
+        )
+
+
+def read_segment(locate, start, frames, channels, sampwidth):
+    """Yields PCM bytes like read_pcm from file, whose path is returned by
+    locate just before it is read. File replaced meanwhile, like WAV file
+    transcoded to FLAC, is located again.
+    """
+    try:
+        blocks = read_pcm(locate(), start, frames, channels, sampwidth)
+        first = next(blocks, None)
+    except FileNotFoundError:
+        blocks = read_pcm(locate(), start, frames, channels, sampwidth)
+        first = next(blocks, None)
+    if first is not None:
+        yield first
+        yield from blocks
+
+
+def stitch_wav(segments, frames, samplerate, channels, sampwidth):
+    """Generates WAV file of given number of frames put together from parts
+    of audio files. Segments are (position, locate) pairs ordered by
+    position of beginning of file in frames of output, which may be
+    negative; locate returns path of file once its part is read. Parts of
+    file overlapping previous one are skipped and gaps between files are
+    filled with silence.
+    """
+    block_align = channels * sampwidth
+    yield wav_header(frames, samplerate, channels, sampwidth)
+    cursor = 0
+    for position, locate in segments:
+        if position >= frames:
+            break
+        if position > cursor:
+            yield from silence(position - cursor, block_align)
+            cursor = position
+        for data in read_segment(locate, cursor - position, frames - cursor,
+                                 channels, sampwidth):
+            yield data
+            cursor += len(data) // block_align
+    yield from silence(frames - cursor, block_align)
@@ -0,0 +1,326 @@
+"""Caches kept in memory of worker process, each bounded in size and age of
+its entries or invalidated by version stamps of database tables shared by
+all workers, and cache of responses shared by workers of one host. Calls
+of identical queries in flight are coalesced too.
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from flask import current_app as app
+
+
+class TTLCache:
+    """Mapping of at most maxsize entries, each of which expires ttl seconds
+    after it was set. Least recently used entries are evicted first. Safe to
+    use from multiple threads.
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.entries[key]
+            except KeyError:
+                return default
+            if expires <= self.timer():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, self.timer() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def versions_dir():
+    return app.config["UPLOADS_DEFAULT_DEST"] / ".versions"
+
+
+def table_version(table):
+    """Returns stamp of table, which changes with every committed write to
+    it. Stamps are files in media directory, so workers of all processes
+    compare them at cost of single stat call.
+    """
+    try:
+        stat = (versions_dir() / table).stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def bump_table_version(table):
+    directory = versions_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    # new file has new inode, so stamp changes even within timer resolution
+    fd, name = tempfile.mkstemp(dir=str(directory), prefix='.')
+    os.close(fd)
+    os.replace(name, str(directory / table))
+
+
+class VersionedCache:
+    """Cache of values loaded from database tables, which is emptied once
+    version of any of these tables changes. Holds at most maxsize values.
+    """
+
+    instances = []
+
+    def __init__(self, tables, maxsize=4096):
+        self.tables = tables
+        self.maxsize = maxsize
+        self.version = None
+        self.values = {}
+        self.lock = threading.Lock()
+        self.instances.append(self)
+
+    def get(self, key, load):
+        """Returns cached value of key, calling load to get missing one."""
+        version = tuple(table_version(table) for table in self.tables)
+        with self.lock:
+            if version != self.version:
+                self.values, self.version = {}, version
+            elif key in self.values:
+                return self.values[key]
+        # loaded value is at least as recent as version read before loading
+        value = load()
+        with self.lock:
+            if self.version == version:
+                if len(self.values) >= self.maxsize:
+                    self.values.clear()
+                self.values[key] = value
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.values, self.version = {}, None
+
+
+# seconds, for which recently used entry is not marked as used again
+RESPONSE_TOUCH_INTERVAL = 5
+
+
+class ResponseCache:
+    """Cache of serialized responses in SQLite file shared by worker
+    processes of one host. Least recently used entries are evicted once
+    their total size exceeds maxsize bytes. Errors of database, like lock
+    timeouts, make it behave as empty cache rather than fail requests.
+    """
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.local = threading.local()
+
+    def connect(self):
+        # connections can not be shared by threads, nor by forked processes
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), timeout=0.5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, '
+                'value BLOB NOT NULL, size INTEGER NOT NULL, '
+                'used REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_response_used '
+                               'ON response (used)')
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return self.local.connection
+
+    def get(self, key):
+        try:
+            connection = self.connect()
+            row = connection.execute(
+                'SELECT value, used FROM response WHERE key = ?', (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        value, used = row
+        now = time.time()
+        # hits write only seldom, as all workers wait for the same lock
+        if now - used > RESPONSE_TOUCH_INTERVAL:
+            try:
+                connection.execute(
+                    'UPDATE response SET used = ? WHERE key = ?', (now, key)
+                )
+            except sqlite3.Error:
+                pass
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.maxsize:
+            return
+        try:
+            connection = self.connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute(
+                    'INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?)',
+                    (key, value, len(value), time.time())
+                )
+                excess, = connection.execute(
+                    'SELECT SUM(size) FROM response'
+                ).fetchone()
+                excess -= self.maxsize
+                evicted = []
+                for old_key, size in connection.execute(
+                        'SELECT key, size FROM response ORDER BY used'):
+                    if excess <= 0:
+                        break
+                    evicted.append((old_key,))
+                    excess -= size
+                connection.executemany('DELETE FROM response WHERE key = ?',
+                                       evicted)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        if getattr(self.local, 'pid', None) == os.getpid():
+            self.local.connection.close()
+        self.local = threading.local()
+
+
+response_cache = None
+
+
+def get_response_cache():
+    """Returns response cache configured by RESPONSE_CACHE_SIZE and
+    RESPONSE_CACHE_PATH settings, or None if it is disabled.
+    """
+    global response_cache
+    if response_cache is None and app.config["RESPONSE_CACHE_SIZE"]:
+        path = app.config["RESPONSE_CACHE_PATH"] or \
+            app.config["UPLOADS_DEFAULT_DEST"] / ".cache" / "responses.sqlite"
+        response_cache = ResponseCache(Path(path),
+                                       app.config["RESPONSE_CACHE_SIZE"])
+    return response_cache
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls of the same key in worker process. While
+    one call runs, callers of its key wait at most timeout seconds to share
+    its result rather than call again. Results of None are not shared, nor
+    are results of failed calls; waiting callers make their own then.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.stats = {'executed': 0, 'coalesced': 0, 'timed_out': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def do(self, key, func):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                flight.waiters += 1
+        if leader:
+            self.count('executed')
+            try:
+                flight.result = func()
+                return flight.result
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+        if not flight.done.wait(self.timeout):
+            self.count('timed_out')
+        elif flight.result is not None:
+            self.count('coalesced')
+            return flight.result
+        self.count('executed')
+        return func()
+
+
+single_flight = None
+
+
+def get_single_flight():
+    """Returns coalescer of requests waiting at most COALESCING_TIMEOUT
+    seconds, or None if coalescing is disabled.
+    """
+    global single_flight
+    if single_flight is None and app.config["COALESCING_TIMEOUT"]:
+        single_flight = SingleFlight(app.config["COALESCING_TIMEOUT"])
+    return single_flight
+
+
+recorder_tokens = None
+recorders = None
+series_owners = None
+
+
+def get_recorder_caches():
+    """Returns cache of verified recorder keys mapped to recorder uids,
+    cache of recorder identities by uid and cache of uids of recorders
+    maintaining series by series uid. Entries of the latter two are keyed
+    with version of recorder or series table too, so changes committed by
+    any process are seen at once.
+    """
+    global recorder_tokens, recorders, series_owners
+    if recorders is None:
+        size = app.config["RECORDER_CACHE_SIZE"]
+        ttl = app.config["RECORDER_CACHE_TTL"]
+        recorder_tokens, recorders = TTLCache(size, ttl), TTLCache(size, ttl)
+        series_owners = TTLCache(app.config["SERIES_OWNER_CACHE_SIZE"], ttl)
+    return recorder_tokens, recorders, series_owners
+
+
+def clear_caches():
+    global response_cache, single_flight
+    single_flight = None
+    if response_cache is not None:
+        response_cache.close()
+        response_cache = None
+    for cache in (recorder_tokens, recorders, series_owners):
+        if cache is not None:
+            cache.clear()
+    for cache in VersionedCache.instances:
+        cache.clear()
@@ -0,0 +1,108 @@
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from . import audio
+from .dataset import data_path, export_filters, export_records
+from .labapp_api import filter_records
+from .models import (
+    relayout_record_files, remove_expired_upload_sessions,
+    remove_unreferenced_blobs, Series
+)
+from .storage import check_features_config, features_config
+from .tasks import compute_series_features, transcode_records
+
+media = AppGroup('media', help='Manage uploaded record files.')
+
+
+@media.command('cleanup-uploads')
+def cleanup_uploads():
+    """Remove expired resumable upload sessions and their partial files."""
+    removed = remove_expired_upload_sessions()
+    click.echo('Removed {} expired upload sessions.'.format(removed))
+
+
+@media.command('gc')
+def collect_garbage():
+    """Remove content addressed blobs no longer referenced by any record."""
+    removed = remove_unreferenced_blobs()
+    click.echo('Removed {} unreferenced blobs.'.format(removed))
+
+
+@media.command('relayout')
+@click.option('--workers', type=int, default=None,
+              help='Number of files moved in parallel.')
+@click.option('--restart', is_flag=True,
+              help='Start over instead of resuming interrupted relayout.')
+def relayout(workers, restart):
+    """Move uploaded record files into currently configured MEDIA_LAYOUT."""
+    workers = workers or current_app.config['RELAYOUT_WORKERS']
+    moved = relayout_record_files(workers, restart)
+    click.echo('Moved {} record files.'.format(moved))
+
+
+@media.command('transcode')
+@click.option('--workers', type=int, default=None,
+              help='Number of files transcoded in parallel.')
+def transcode(workers):
+    """Transcode uploaded record files still stored as WAV to FLAC."""
+    workers = workers or current_app.config['TRANSCODE_WORKERS']
+    transcoded = transcode_records(workers)
+    click.echo('Transcoded {} record files.'.format(transcoded))
+
+
+@media.command('features')
+@click.argument('series_uid')
+@click.option('--workers', type=int, default=None,
+              help='Number of processes computing features.')
+@click.option('--kind', type=click.Choice(audio.FEATURE_KINDS), default=None)
+@click.option('--n-fft', type=int, default=None)
+@click.option('--hop-length', type=int, default=None)
+@click.option('--n-mels', type=int, default=None)
+def features(series_uid, workers, kind, n_fft, hop_length, n_mels):
+    """Compute spectral features of uploaded records of series ahead of
+    requests. Options not given are taken from FEATURES setting.
+    """
+    if Series.query.filter_by(uid=series_uid).one_or_none() is None:
+        raise click.BadParameter('Series {} not found.'.format(series_uid))
+    workers = workers or current_app.config['FEATURES_WORKERS']
+    config = features_config(kind=kind, n_fft=n_fft, hop_length=hop_length,
+                             n_mels=n_mels)
+    try:
+        check_features_config(config)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex))
+    computed = compute_series_features(series_uid, workers, config)
+    click.echo('Computed features of {} records.'.format(computed))
+
+
+@media.command('export')
+@click.option('--series-uid', multiple=True,
+              help='Export records from specific series.')
+@click.option('--recorded-from', default=None)
+@click.option('--recorded-to', default=None)
+@click.option('--label', multiple=True,
+              help='Export records specifically labeled.')
+@click.option('--labeled/--unlabeled', default=None)
+def export(series_uid, recorded_from, recorded_to, label, labeled):
+    """Append samples of uploaded records matching filters, which are not
+    exported yet, to packed dataset, or rebuild it once exported records
+    changed.
+    """
+    filters = export_filters(series_uid, recorded_from, recorded_to, label,
+                             labeled)
+    records = filter_records(series_uid, recorded_from, recorded_to, None,
+                             label, labeled)
+    try:
+        index = export_records(filters, records)
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+    if index is None:
+        click.echo('No uploaded records match given filters.')
+        return
+    click.echo('Export {} holds {} records in {}.'.format(
+        index['key'], index['shape'][0], data_path(index['key'])))
+
+
+def init_app(app):
+    app.cli.add_command(media)
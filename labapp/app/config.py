@@ -11,6 +11,48 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY',
                            default='uber-secretly-keeped-in-memory-key')
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    RECORDS_STREAM_BATCH_SIZE = 1000
+    RECORD_BATCH_MAX_SIZE = 1000
+    # batches are refused by their length before records are parsed
+    RECORD_BATCH_MAX_BYTES = RECORD_BATCH_MAX_SIZE * 1024
+    # verified recorder keys and identities kept by every worker process
+    RECORDER_CACHE_SIZE = 4096
+    RECORDER_CACHE_TTL = 60
+    SERIES_OWNER_CACHE_SIZE = 65536
+    # responses of GET /record, /recorder and /series shared by workers of
+    # host, 0 disables the cache; kept in media directory unless path is set
+    RESPONSE_CACHE_SIZE = 64 * 1024 * 1024
+    RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH')
+    # seconds identical GET /record and /series requests wait for query of
+    # the first one in flight, 0 disables coalescing
+    COALESCING_TIMEOUT = 10
+    UPLOAD_SESSION_TTL = 24 * 60 * 60
+    UPLOAD_CHUNK_MAX_SIZE = 16 * 1024 * 1024
+    # allowed difference between frames of uploaded WAV and series duration
+    WAV_FRAMES_TOLERANCE = 1
+    # 'filesystem' or 'content-addressed'
+    MEDIA_STORAGE = os.getenv('MEDIA_STORAGE', default='filesystem')
+    MEDIA_GC_GRACE_PERIOD = 60 * 60
+    # 'flat', 'date' (<series>/YYYY/MM/DD/) or 'uid' (<series>/ab/cd/);
+    # files are looked up in other layouts too until 'flask media relayout'
+    # finishes
+    MEDIA_LAYOUT = os.getenv('MEDIA_LAYOUT', default='flat')
+    RELAYOUT_WORKERS = 8
+    # transcode uploaded WAV files to FLAC in background
+    MEDIA_FLAC = bool(os.getenv('MEDIA_FLAC'))
+    BACKGROUND_WORKERS = 2
+    TRANSCODE_WORKERS = 4
+    # None, 'x-accel-redirect' (nginx) or 'x-sendfile' (apache, lighttpd)
+    DOWNLOAD_OFFLOAD = os.getenv('DOWNLOAD_OFFLOAD')
+    DOWNLOAD_ACCEL_PREFIX = os.getenv('DOWNLOAD_ACCEL_PREFIX',
+                                      default='/protected-media/')
+    # spectral features returned by default, kind is 'stft' or 'log-mel'
+    FEATURES = {
+        'kind': 'log-mel', 'n_fft': 1024, 'hop_length': 512, 'n_mels': 64
+    }
+    FEATURES_WORKERS = os.cpu_count()
+    # sample type of packed datasets, 'int16' or 'float32'
+    EXPORT_DTYPE = 'int16'
 
 
 class ProductionConfig(Config):
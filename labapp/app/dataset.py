@@ -0,0 +1,192 @@
+"""Packed datasets: samples of many records written one after another into
+single raw file, that training readers memory map as array shaped
+(records, samples, channels), with JSON index describing its rows.
+"""
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+from flask import current_app as app
+from sqlalchemy import orm
+
+from app import audio
+from app.models import Record, Series
+from app.storage import remove_file, replace_file
+
+
+def exports_dir():
+    return app.config["UPLOADS_DEFAULT_DEST"] / ".exports"
+
+
+def export_filters(series_uid=None, recorded_from=None, recorded_to=None,
+                   label=None, labeled=None):
+    """Returns filters of GET /record in canonical form, which identifies
+    export of records matching them.
+    """
+    return {
+        'series_uid': sorted(series_uid) if series_uid else None,
+        'recorded_from': recorded_from,
+        'recorded_to': recorded_to,
+        'label': sorted(label) if label else None,
+        'labeled': labeled
+    }
+
+
+def export_key(filters):
+    """Returns hash of records filters, that names directory of export."""
+    data = json.dumps(filters, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def data_path(key):
+    return exports_dir() / key / 'data.raw'
+
+
+def index_path(key):
+    return exports_dir() / key / 'index.json'
+
+
+def error_path(key):
+    return exports_dir() / key / 'error.txt'
+
+
+def read_error(key):
+    """Returns message of failure of last update of export with given key,
+    or None if it did not fail.
+    """
+    try:
+        return error_path(key).read_text()
+    except FileNotFoundError:
+        return None
+
+
+def read_index(key):
+    """Returns index of export with given key, or None if there is no such
+    export.
+    """
+    try:
+        with open(str(index_path(key))) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def locked(key):
+    """Serializes updates of export among threads and processes."""
+    directory = exports_dir() / key
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(str(directory / '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def new_index(key, filters, parameters):
+    return {
+        'key': key,
+        'filters': filters,
+        'dtype': np.dtype(app.config['EXPORT_DTYPE']).str,
+        'samplerate': parameters.samplerate,
+        'channels': parameters.channels,
+        'samples': int(round(parameters.duration * parameters.samplerate)),
+        'shape': [0, 0, 0],
+        'records': []
+    }
+
+
+def check_parameters(index, record):
+    parameters = record.series.parameters
+    shape = (parameters.samplerate, parameters.channels,
+             int(round(parameters.duration * parameters.samplerate)))
+    if shape != (index['samplerate'], index['channels'], index['samples']):
+        raise ValueError(
+            "Record {} has samplerate {}, {} channels and {} samples, while "
+            "export holds {}, {} and {}".format(
+                record.uid, *shape, index['samplerate'], index['channels'],
+                index['samples'])
+        )
+
+
+def export_records(filters, records):
+    """Appends samples of uploaded records from given query, which are not
+    exported yet, to export identified by filters. All records must share
+    recording parameters; files differing slightly in length are padded or
+    truncated to samples of series duration. Export is rebuilt into new raw
+    file, once exported record is relabelled, uploaded again or no longer
+    matches filters, so readers mapping previous file are not disturbed.
+    Returns index of export.
+    """
+    key = export_key(filters)
+    batch_size = app.config['RECORDS_STREAM_BATCH_SIZE']
+    with locked(key):
+        remove_file(error_path(key))
+        index = read_index(key)
+        exported = {} if index is None else \
+            {entry['uid']: entry for entry in index['records']}
+        records = records.filter(Record.uploaded_at != None).options(
+            orm.joinedload(Record.series).joinedload(Series.parameters)
+        )
+        rows, new, stale = [], [], False
+        for record in records.yield_per(batch_size):
+            if not record.is_uploaded():
+                continue
+            if index is None:
+                index = new_index(key, filters, record.series.parameters)
+            check_parameters(index, record)
+            entry = {
+                'uid': record.uid,
+                'series_uid': record.series_uid,
+                'label_uid': record.label_uid,
+                'start_time': record.start_time,
+                'checksum': record.checksum
+            }
+            previous = exported.pop(record.uid, None)
+            if previous is None:
+                new.append((record.filepath, entry))
+            elif (previous['label_uid'], previous['checksum']) != \
+                    (record.label_uid, record.checksum):
+                stale = True
+            rows.append((record.filepath, entry))
+        # records left were deleted or no longer match filters
+        stale = stale or bool(exported)
+        if index is None or not (new or stale):
+            return index
+        path = data_path(key)
+        if stale:
+            index['records'] = []
+            replace_file(path, lambda name: append_rows(name, index, rows))
+        else:
+            append_rows(path, index, new)
+        index['shape'] = [len(index['records']), index['samples'],
+                          index['channels']]
+        index['updated_at'] = datetime.utcnow().isoformat('T')
+        replace_file(index_path(key), lambda name: write_index(name, index))
+    return index
+
+
+def append_rows(path, index, rows):
+    """Appends samples of files of given (path, entry) rows to raw file and
+    their entries to index.
+    """
+    frames, dtype = index['samples'], index['dtype']
+    with open(str(path), 'ab') as data:
+        # rows appended after last written index are dropped
+        data.truncate(len(index['records']) * frames * index['channels'] *
+                      np.dtype(dtype).itemsize)
+        for filepath, entry in rows:
+            data.write(audio.read_frames(filepath, frames, dtype).tobytes())
+            index['records'].append(entry)
+        data.flush()
+        os.fsync(data.fileno())
+
+
+def write_index(path, index):
+    with open(str(path), 'w') as f:
+        json.dump(index, f, default=str)
@@ -1,25 +1,65 @@
+import hashlib
+import json
 import jwt
+from collections import namedtuple
 from functools import wraps
 
 import flask
 from sqlalchemy.orm import exc
 
+from .cache import (
+    get_recorder_caches, get_response_cache, get_single_flight, table_version
+)
 from .helpers import get_object
-from .models import Recorder
+from .models import db, Recorder, Series
+
+# recorder authenticated by request
+RecorderIdentity = namedtuple('RecorderIdentity', ['uid'])
+
+
+def load_recorder(uid):
+    """Returns identity of recorder with given uid. Raises NoResultFound."""
+    return RecorderIdentity(get_object(Recorder, uid).uid)
+
+
+def series_owner(series_uid):
+    """Returns uid of recorder maintaining series, or None if there is no
+    such series. Series is looked up by its unique uid, so it costs the
+    same however many series recorder has.
+    """
+    owners = get_recorder_caches()[2]
+    # entries of series changed by any process are not found again
+    key = (series_uid, table_version('series'))
+    owner = owners.get(key)
+    if owner is None:
+        owner = db.session.query(Series.recorder_uid).\
+            filter(Series.uid == series_uid).scalar()
+        if owner is not None:
+            owners.set(key, owner)
+    return owner
 
 
 def recorder_required(func):
     @wraps(func)
     def inner(*args, **kwargs):
+        tokens, recorders, _ = get_recorder_caches()
         try:
             token = flask.request.headers.get('recorder_key')
             assert token is not None
             if isinstance(token, str):
                 token = token.encode("utf-8")
-            payload = jwt.decode(token, flask.current_app.config['SECRET_KEY'],
-                                 algorithms=['HS256'])
-            uid = payload.pop('uid')
-            recorder = get_object(Recorder, uid)
+            uid = tokens.get(token)
+            if uid is None:
+                payload = jwt.decode(token,
+                                     flask.current_app.config['SECRET_KEY'],
+                                     algorithms=['HS256'])
+                uid = payload.pop('uid')
+                tokens.set(token, uid)
+            key = (uid, table_version('recorder'))
+            recorder = recorders.get(key)
+            if recorder is None:
+                recorder = load_recorder(uid)
+                recorders.set(key, recorder)
             setattr(flask.g, 'recorder', recorder)
             return func(*args, **kwargs)
         except (jwt.exceptions.InvalidSignatureError, KeyError) as ex:
@@ -27,3 +67,88 @@ def recorder_required(func):
         except (exc.NoResultFound, AssertionError) as ex:
             flask.abort(401)
     return inner
+
+
+def request_key():
+    """Returns path and query parameters of request normalised by their
+    order.
+    """
+    args = sorted((name, sorted(values))
+                  for name, values in flask.request.args.lists())
+    return json.dumps([flask.request.path, args])
+
+
+def response_key(tables):
+    """Returns key of request with versions of tables, so writes committed
+    to any of them make earlier entries unreachable.
+    """
+    versions = [table_version(table) for table in tables]
+    key = json.dumps([request_key(), versions])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def split_result(result):
+    """Returns body, status and headers of handler result."""
+    if not isinstance(result, tuple):
+        result = (result,)
+    body, status, headers = (result + (200, {}))[:3]
+    return body, status, headers
+
+
+def cached_response(*tables):
+    """Caches JSON results of GET handler reading given tables in response
+    cache shared by workers. Streamed responses are not cached.
+    """
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            cache = get_response_cache()
+            if cache is None:
+                return func(*args, **kwargs)
+            # result is at least as recent as versions read before handling
+            key = response_key(tables)
+            value = cache.get(key)
+            if value is not None:
+                return tuple(json.loads(value.decode('utf-8')))
+            result = func(*args, **kwargs)
+            if isinstance(result, flask.Response):
+                return result
+            body, status, headers = split_result(result)
+            cache.set(key, flask.json.dumps([body, status, headers]).
+                      encode('utf-8'))
+            return body, status, headers
+        return inner
+    return decorator
+
+
+def coalesced(*tables):
+    """Shares one call of GET handler reading given tables and its
+    serialised result with identical requests, which arrive at worker while
+    it runs and before any of the tables changes. Streamed responses are not
+    shared.
+    """
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            flights = get_single_flight()
+            if flights is None:
+                return func(*args, **kwargs)
+            streamed = []
+
+            def call():
+                result = func(*args, **kwargs)
+                if isinstance(result, flask.Response):
+                    streamed.append(result)
+                    return None
+                body, status, headers = split_result(result)
+                return flask.json.dumps(body), status, headers
+
+            # writes committed before request do not join older flights
+            shared = flights.do(response_key(tables), call)
+            if shared is None:
+                return streamed[0]
+            body, status, headers = shared
+            return flask.Response(body, status, headers,
+                                  mimetype='application/json')
+        return inner
+    return decorator
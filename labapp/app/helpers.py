@@ -1,6 +1,9 @@
+import base64
+import json
 import jwt
 import time
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from dateutil.parser import parse
 
 from flask import abort, current_app
@@ -22,6 +25,30 @@ def datetime_to_time(dt):
         return time.mktime(dt.timetuple()) + dt.microsecond / 1E6
 
 
+def decode_cursor(cursor):
+    """Decodes pagination cursor created by encode_cursor. Returns tuple of
+    start time (as Decimal) and id of last seen record or raises ValueError.
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        start_time, id = json.loads(
+            base64.urlsafe_b64decode(cursor + padding).decode('utf-8')
+        )
+        return Decimal(start_time), int(id)
+    except (TypeError, ValueError, InvalidOperation, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+
+def encode_cursor(start_time, id):
+    """Encodes position of record in (start_time, id) ordering into opaque
+    string, that can be passed back to continue listing after this record.
+    Start time is kept exactly, so decoded one equals stored one.
+    """
+    payload = json.dumps([repr(float(start_time)), id])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).\
+        decode('utf-8').rstrip('=')
+
+
 def encode_recorder_key(recorder_uid):
     payload = {'uid': recorder_uid}
     key = jwt.encode(payload, current_app.config['SECRET_KEY'],
@@ -88,6 +115,19 @@ def parse_filtering_dates(created_from=None, created_to=None,
     return created_from, created_to
 
 
+def parse_time_window(start, stop):
+    """Parses beginning and end of time window. Returns them as timestamps
+    or raises ValueError.
+    """
+    try:
+        start, stop = parse(start), parse(stop)
+    except (ValueError, OverflowError):
+        raise ValueError('Invalid datetime format')
+    if stop <= start:
+        raise ValueError("End of time window must be after its beginning")
+    return datetime_to_time(start), datetime_to_time(stop)
+
+
 def string_to_datetime(date_string):
     for f in [DATE_FORMAT, DATETIME_FORMAT, ISO_DATETIME_FORMAT]:
         try:
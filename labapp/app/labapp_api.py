@@ -1,17 +1,47 @@
 import flask
+import uuid
+from collections import OrderedDict
 from connexion import request
 from datetime import datetime
+from functools import partial
 from sqlalchemy import and_, exc, orm, or_
 
-from app.decorators import recorder_required
+from app.archive import ARCHIVE_FORMATS
+from app.audio import (
+    analysis_available, check_wav, read_peaks, stitch_wav
+)
+from app.cache import get_single_flight
+from app.dataset import (
+    data_path, error_path, export_filters, export_key, read_error, read_index
+)
+from app.decorators import (
+    cached_response, coalesced, recorder_required, series_owner
+)
 from app.helpers import (
-    get_object, get_object_or_404, increase_last_digit, parse_filtering_dates
+    decode_cursor, encode_cursor, get_object, get_object_or_404,
+    increase_last_digit, parse_filtering_dates, parse_time_window
+)
+from app.models import (
+    all_labels, db, remove_expired_upload_sessions, Label, Record, Recorder,
+    RecordingParameters, Series, series_parameters, tables_changed,
+    UploadSession
+)
+from app.storage import (
+    check_features_config, features_config, features_path, get_storage,
+    hash_file, hashing_upload, remove_file, save_file, save_peaks,
+    save_upload, send_decoded_wav, send_file, sidecar_path, write_chunk,
+    write_features
 )
-from app.models import db, Label, Record, Recorder, RecordingParameters, Series
+from app.tasks import run_in_background, schedule_processing, update_export
 
 
 def get_labels():
-    return [l.to_dict() for l in Label.query.all()]
+    return list(all_labels().values())
+
+
+def check_label_exists(label_uid):
+    if label_uid not in all_labels():
+        flask.abort(404, "Label {} not found".format(label_uid))
 
 
 def new_label():
@@ -28,8 +58,11 @@ def new_label():
         flask.abort(400, str(ex))
 
 
-def get_records(series_uid=None, recorded_from=None, recorded_to=None,
-                uploaded=None, label=None, labeled=None):
+def filter_records(series_uid=None, recorded_from=None, recorded_to=None,
+                   uploaded=None, label=None, labeled=None):
+    """Builds query of records matching filters of GET /record, ordered
+    by start time.
+    """
     filters = []
     rf, rt = parse_filtering_dates(recorded_from, recorded_to, True)
     if rf:
@@ -42,9 +75,9 @@ def get_records(series_uid=None, recorded_from=None, recorded_to=None,
         )
     if uploaded is not None:
         if uploaded:
-            filters.append(Record.uploaded_at is not None)
+            filters.append(Record.uploaded_at != None)
         else:
-            filters.append(Record.uploaded_at is None)
+            filters.append(Record.uploaded_at == None)
     if label:
         filters.append(
             or_(*[Record.label_uid == uid for uid in label])
@@ -54,20 +87,109 @@ def get_records(series_uid=None, recorded_from=None, recorded_to=None,
             filters.append(Record.label_uid != None)
         else:
             filters.append(Record.label_uid == None)
-    records = Record.query.filter(and_(*filters))
-    return [r.to_dict() for r in records]
+    return Record.query.filter(and_(*filters)).\
+        order_by(Record.start_time, Record.id)
+
+
+@coalesced('record')
+@cached_response('record')
+def get_records(series_uid=None, recorded_from=None, recorded_to=None,
+                uploaded=None, label=None, labeled=None, limit=None,
+                cursor=None, stream=False):
+    records = filter_records(series_uid, recorded_from, recorded_to,
+                             uploaded, label, labeled)
+    if cursor:
+        try:
+            start_time, id = decode_cursor(cursor)
+        except ValueError as ex:
+            flask.abort(400, str(ex))
+        records = records.filter(or_(
+            Record.start_time > start_time,
+            and_(Record.start_time == start_time, Record.id > id)
+        ))
+    if limit:
+        records = records.limit(limit)
+    if stream:
+        batch_size = flask.current_app.config['RECORDS_STREAM_BATCH_SIZE']
+        return flask.Response(
+            flask.stream_with_context(
+                flask.json.dumps(r.to_dict()) + '\n'
+                for r in records.yield_per(batch_size)
+            ),
+            mimetype='application/x-ndjson'
+        )
+    records = records.all()
+    headers = {}
+    if limit and len(records) == limit:
+        headers['X-Next-Cursor'] = encode_cursor(records[-1].start_time,
+                                                 records[-1].id)
+    return [r.to_dict() for r in records], 200, headers
+
+
+def get_records_archive(series_uid=None, recorded_from=None,
+                        recorded_to=None, uploaded=None, label=None,
+                        labeled=None, format='zip'):
+    records = filter_records(series_uid, recorded_from, recorded_to,
+                             uploaded, label, labeled)
+    batch_size = flask.current_app.config['RECORDS_STREAM_BATCH_SIZE']
+    generate, mimetype = ARCHIVE_FORMATS[format]
+    response = flask.Response(
+        flask.stream_with_context(generate(records.yield_per(batch_size))),
+        mimetype=mimetype
+    )
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename='records.' + format)
+    return response
+
+
+def export_records_dataset(series_uid=None, recorded_from=None,
+                           recorded_to=None, label=None, labeled=None):
+    filters = export_filters(series_uid, recorded_from, recorded_to, label,
+                             labeled)
+    query = partial(filter_records, series_uid, recorded_from, recorded_to,
+                    None, label, labeled)
+    try:
+        # invalid filters are reported before scheduling
+        query()
+    except ValueError as ex:
+        flask.abort(400, str(ex))
+    key = export_key(filters)
+    remove_file(error_path(key))
+    run_in_background(update_export, filters, query)
+    return ({'key': key}, 202,
+            {'Location': request.base_url.rstrip('/') + '/' + key})
+
+
+def get_records_dataset(export_key):
+    error = read_error(export_key)
+    if error is not None:
+        flask.abort(409, error)
+    index = read_index(export_key)
+    if index is None:
+        flask.abort(404, "Export {} not found".format(export_key))
+    return index
+
+
+def download_records_dataset(export_key):
+    if read_index(export_key) is None:
+        flask.abort(404, "Export {} not found".format(export_key))
+    return send_file(data_path(export_key), export_key + '.raw',
+                     'application/octet-stream')
+
+
+def check_series_maintained(recorder, series_uid):
+    if series_owner(series_uid) != recorder.uid:
+        flask.abort(403, "Recorder {} does not maintain series {}".format(
+            recorder.uid, series_uid
+        ))
 
 
 @recorder_required
 def new_record():
     record_data = request.get_json()
-    recorder = flask.g.recorder
-    if record_data["series_uid"] not in [s.uid for s in recorder.serieses]:
-        flask.abort(403, "Recorder {} does not maintain series {}".format(
-            recorder.uid, record_data["series_uid"]
-        ))
+    check_series_maintained(flask.g.recorder, record_data["series_uid"])
     if record_data["label_uid"] is not None:
-        get_object_or_404(Label, record_data["label_uid"])
+        check_label_exists(record_data["label_uid"])
     try:
         record = Record(**record_data)
         db.session.add(record)
@@ -80,15 +202,83 @@ def new_record():
         flask.abort(400, str(ex))
 
 
+@recorder_required
+def new_records_batch():
+    records_data = request.get_json()
+    max_size = flask.current_app.config['RECORD_BATCH_MAX_SIZE']
+    if len(records_data) > max_size:
+        flask.abort(413, "Batch exceeds maximum size of {} records".format(
+            max_size))
+    series_uids = {r['series_uid'] for r in records_data}
+    durations = dict(
+        db.session.query(Series.uid, RecordingParameters.duration).
+        outerjoin(Series.parameters).
+        filter(Series.uid.in_(series_uids)).
+        filter(Series.recorder_uid == flask.g.recorder.uid)
+    )
+    labels = all_labels()
+    uids = {r['uid'] for r in records_data if r.get('uid')}
+    taken_uids = {uid for uid, in db.session.query(Record.uid).
+                  filter(Record.uid.in_(uids))}
+    created_at = datetime.now()
+    results = []
+    rows = []
+    for record_data in records_data:
+        uid = record_data.get('uid') or str(uuid.uuid4())
+        series_uid = record_data['series_uid']
+        label_uid = record_data.get('label_uid')
+        if series_uid not in durations:
+            results.append({'uid': uid, 'status': 403, 'detail':
+                            "Recorder {} does not maintain series {}".
+                            format(flask.g.recorder.uid, series_uid)})
+            continue
+        if label_uid is not None and label_uid not in labels:
+            results.append({'uid': uid, 'status': 404, 'detail':
+                            "Label {} not found".format(label_uid)})
+            continue
+        if uid in taken_uids:
+            results.append({'uid': uid, 'status': 409, 'detail':
+                            "Record {} already exists".format(uid)})
+            continue
+        taken_uids.add(uid)
+        duration = durations[series_uid]
+        row = {
+            'uid': uid,
+            'created_at': created_at,
+            'series_uid': series_uid,
+            'label_uid': label_uid,
+            'start_time': record_data['start_time'],
+            'duration': duration,
+            'stop_time': record_data['start_time'] + duration
+            if duration is not None else None
+        }
+        rows.append(row)
+        results.append({'uid': uid, 'status': 200,
+                        'record': Record(**row).to_dict()})
+    if rows:
+        try:
+            db.session.execute(Record.__table__.insert(), rows)
+            tables_changed(db.session(), 'record')
+            db.session.commit()
+        except exc.IntegrityError as ex:
+            db.session.rollback()
+            flask.abort(400, str(ex))
+    return results
+
+
 def get_record(record_uid):
     return get_object_or_404(Record, record_uid).to_dict()
 
 
 def delete_record(record_uid):
     record = get_object_or_404(Record, record_uid)
-    if record.filepath.exists():
-        record.filepath.unlink()
+    # partial files of upload sessions deleted along with record
+    session_files = [s.filepath for s in record.upload_sessions]
     db.session.delete(record)
+    db.session.commit()
+    get_storage().delete(record)
+    for path in session_files:
+        remove_file(path)
     return ('Record deleted', 204)
 
 
@@ -96,8 +286,8 @@ def get_records_label(record_uid):
     record = get_object_or_404(Record, record_uid)
     if record.label_uid is None:
         return {}
-    label = get_object_or_404(Label, record.label_uid)
-    return label.to_dict()
+    check_label_exists(record.label_uid)
+    return all_labels()[record.label_uid]
 
 
 def update_records_label(record_uid):
@@ -105,16 +295,74 @@ def update_records_label(record_uid):
     data = request.get_json()
     label_uid = data.pop('label_uid')
     if label_uid is not None:
-        get_object_or_404(Label, label_uid)
+        check_label_exists(label_uid)
     record.label_uid = label_uid
     db.session.add(record)
     db.session.commit()
     return record.to_dict()
 
 
+def get_record_peaks(record_uid, width=1000):
+    record = get_object_or_404(Record, record_uid)
+    if not record.is_uploaded():
+        flask.abort(
+            404, "This record is registered but file has not been uploaded yet"
+        )
+    path = sidecar_path(record, '.peaks')
+    if not path.exists():
+        if not analysis_available():
+            flask.abort(404, "Peaks of record {} are not available".format(
+                record_uid))
+        # not computed yet, or lost by re-upload racing with processing
+        try:
+            path = save_peaks(record)
+        except ValueError:
+            # file uploaded before its header was checked
+            flask.abort(404, "Peaks of record {} are not available".format(
+                record_uid))
+        if path is None:
+            flask.abort(409, "Record file was replaced while computing its "
+                             "peaks, try again")
+    return read_peaks(path, width)
+
+
+def get_record_features(record_uid, kind=None, n_fft=None, hop_length=None,
+                        n_mels=None):
+    record = get_object_or_404(Record, record_uid)
+    if not record.is_uploaded():
+        flask.abort(
+            404, "This record is registered but file has not been uploaded yet"
+        )
+    config = features_config(kind=kind, n_fft=n_fft, hop_length=hop_length,
+                             n_mels=n_mels)
+    try:
+        check_features_config(config)
+    except ValueError as ex:
+        flask.abort(400, str(ex))
+    path = features_path(record, config)
+    if not path.exists():
+        if not analysis_available():
+            flask.abort(404, "Features of record {} are not available".format(
+                record_uid))
+        # only features of FEATURES setting are computed within request
+        if config != features_config():
+            flask.abort(404, "Features of record {} are not computed with "
+                             "given configuration".format(record_uid))
+        try:
+            written = write_features(record.filepath, path, config)
+        except ValueError:
+            # file uploaded before its header was checked
+            flask.abort(404, "Features of record {} are not available".format(
+                record_uid))
+        if not written:
+            flask.abort(409, "Record file was replaced while computing its "
+                             "features, try again")
+    return send_file(path, record.uid + '.npy', 'application/octet-stream')
+
+
 def get_record_parameters(record_uid):
     record = get_object_or_404(Record, record_uid)
-    return record.series.parameters.to_dict()
+    return series_parameters(record.series_uid)._asdict()
 
 
 def download_record(record_uid):
@@ -123,37 +371,226 @@ def download_record(record_uid):
         flask.abort(
             404, "This record is registered but file has not been uploaded yet"
         )
-    return flask.send_file(str(record.filepath),
-                           attachment_filename=record.filepath.name)
+    path = record.filepath
+    if path.suffix != '.flac':
+        return send_file(path, record.filename)
+    if request.accept_mimetypes.best_match(['audio/wav', 'audio/flac']) == \
+            'audio/flac':
+        response = send_file(path, str(record.uid) + '.flac', 'audio/flac')
+    else:
+        response = send_decoded_wav(path, record.filename)
+    response.vary.add('Accept')
+    return response
 
 
-@recorder_required
-def upload_record(record_uid):
-    record = get_object_or_404(Record, record_uid)
-    recorder = flask.g.recorder
-    if record.series_uid not in [s.uid for s in recorder.serieses]:
-        flask.abort(403, "Recorder {} does not maintain series {}".format(
-            recorder.uid, record.series_uid
-        ))
+def get_uploaded_file():
     try:
         file = request.files['file']
         if file.filename.split('.')[-1] != 'wav':
             raise TypeError("Attached file has wrong format")
+        return file
     except KeyError:
         flask.abort(400, "No file has been attached to request")
     except TypeError as ex:
         flask.abort(400, str(ex))
-    if record.filepath.exists():
-        record.filepath.unlink()
-    file.save(str(record.filepath))
+
+
+def check_uploaded_wav(record, digest, parameters):
+    """Validates header of uploaded WAV file against recording parameters
+    of series and stores its metadata on record.
+    """
+    try:
+        header = check_wav(
+            digest.wav, digest.size, parameters,
+            flask.current_app.config['WAV_FRAMES_TOLERANCE']
+        )
+    except ValueError as ex:
+        flask.abort(400, str(ex))
+    record.frames = header.frames
+    record.bit_depth = header.bits_per_sample
+
+
+def check_ingested_again(record, file):
+    """Returns record, which already has the same file uploaded, so retried
+    ingest succeeds. Aborts if it has different file.
+    """
+    if record.checksum == hashing_upload(file).checksum:
+        return record.to_dict()
+    flask.abort(409, "Record {} already has different file uploaded".
+                format(record.uid))
+
+
+@recorder_required
+def ingest_record():
+    record_data = request.form
+    file = get_uploaded_file()
+    check_series_maintained(flask.g.recorder, record_data['series_uid'])
+    # concurrent ingests of registered record wait for each other
+    record = Record.query.filter_by(uid=record_data['uid']).\
+        with_for_update().one_or_none()
+    parameters = series_parameters(record_data['series_uid'])
+    if record is None:
+        label_uid = record_data.get('label_uid') or None
+        if label_uid is not None:
+            check_label_exists(label_uid)
+        record = Record(uid=record_data['uid'],
+                        series_uid=record_data['series_uid'],
+                        start_time=float(record_data['start_time']),
+                        label_uid=label_uid)
+        db.session.add(record)
+    elif record.series_uid != record_data['series_uid']:
+        flask.abort(409, "Record {} is registered in series {}".format(
+            record.uid, record.series_uid))
+    elif record.is_uploaded():
+        return check_ingested_again(record, file)
+    check_uploaded_wav(record, hashing_upload(file).digest, parameters)
+    try:
+        # file is stored only by ingest, which inserted the record
+        db.session.flush()
+    except exc.IntegrityError as ex:
+        db.session.rollback()
+        record = Record.query.filter_by(uid=record_data['uid']).\
+            one_or_none()
+        if record is None or record.uploaded_at is None:
+            flask.abort(409, str(ex))
+        return check_ingested_again(record, file)
+    save_upload(record, file)
+    record.uploaded_at = datetime.now()
+    try:
+        db.session.commit()
+    except exc.IntegrityError as ex:
+        db.session.rollback()
+        flask.abort(409, str(ex))
+    schedule_processing(record)
+    return record.to_dict()
+
+
+@recorder_required
+def upload_record(record_uid):
+    record = get_object_or_404(Record, record_uid)
+    check_series_maintained(flask.g.recorder, record.series_uid)
+    file = get_uploaded_file()
+    check_uploaded_wav(record, hashing_upload(file).digest,
+                       series_parameters(record.series_uid))
+    save_upload(record, file)
     record.uploaded_at = datetime.now()
     db.session.add(record)
     db.session.commit()
+    schedule_processing(record)
     return record.to_dict()
 
 
+def get_upload_session_or_404(record_uid, session_uid):
+    upload_session = get_object_or_404(UploadSession, session_uid)
+    if upload_session.record_uid != record_uid or \
+            upload_session.is_expired():
+        flask.abort(404, "Upload session {} of record {} not found".format(
+            session_uid, record_uid))
+    check_series_maintained(flask.g.recorder,
+                            upload_session.record.series_uid)
+    return upload_session
+
+
+def upload_session_headers(upload_session):
+    headers = {
+        'Upload-Offset': str(upload_session.offset),
+        'Cache-Control': 'no-store'
+    }
+    if upload_session.length is not None:
+        headers['Upload-Length'] = str(upload_session.length)
+    return headers
+
+
+@recorder_required
+def new_upload_session(record_uid):
+    record = get_object_or_404(Record, record_uid)
+    check_series_maintained(flask.g.recorder, record.series_uid)
+    session_data = request.get_json() or {}
+    remove_expired_upload_sessions()
+    upload_session = UploadSession(record_uid=record.uid,
+                                   length=session_data.get('length'))
+    db.session.add(upload_session)
+    db.session.commit()
+    upload_session.filepath.parent.mkdir(parents=True, exist_ok=True)
+    upload_session.filepath.touch()
+    return (upload_session.to_dict(), 201,
+            upload_session_headers(upload_session))
+
+
+@recorder_required
+def get_upload_session_offset(record_uid, session_uid):
+    upload_session = get_upload_session_or_404(record_uid, session_uid)
+    return '', 200, upload_session_headers(upload_session)
+
+
+# maximum body sizes of requests by operation, in bytes
+MAX_CONTENT_LENGTHS = {
+    'upload_chunk': 'UPLOAD_CHUNK_MAX_SIZE',
+    'new_records_batch': 'RECORD_BATCH_MAX_BYTES'
+}
+
+
+def check_content_length():
+    """Rejects chunks of resumable uploads and batches of records by their
+    Content-Length, as connexion reads whole request body before handler
+    is called.
+    """
+    operation = (flask.request.endpoint or '').rpartition('labapp_api_')[2]
+    if operation not in MAX_CONTENT_LENGTHS:
+        return
+    max_length = flask.current_app.config[MAX_CONTENT_LENGTHS[operation]]
+    length = flask.request.content_length
+    if length is None:
+        flask.abort(411, "Request must be sent with Content-Length header")
+    if length > max_length:
+        flask.abort(413, "Request exceeds maximum size of {} bytes".format(
+            max_length))
+
+
+@recorder_required
+def upload_chunk(record_uid, session_uid):
+    upload_session = get_upload_session_or_404(record_uid, session_uid)
+    try:
+        offset = int(flask.request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        flask.abort(400, "Missing or invalid Upload-Offset header")
+    if offset != upload_session.offset:
+        flask.abort(409, "Upload offset mismatch, upload continues from {}".
+                    format(upload_session.offset))
+    length = flask.request.content_length
+    if upload_session.length is not None and \
+            offset + length > upload_session.length:
+        flask.abort(400, "Chunk exceeds declared upload length")
+    chunk = flask.request.get_data()
+    if len(chunk) != length:
+        flask.abort(400, "Chunk is shorter than its Content-Length")
+    write_chunk(upload_session.filepath, offset, chunk)
+    upload_session.updated_at = datetime.now()
+    db.session.commit()
+    return '', 204, upload_session_headers(upload_session)
+
+
+@recorder_required
+def finalize_upload_session(record_uid, session_uid):
+    upload_session = get_upload_session_or_404(record_uid, session_uid)
+    if upload_session.length is not None and \
+            upload_session.offset != upload_session.length:
+        flask.abort(409, "Upload is incomplete, {} of {} bytes received".
+                    format(upload_session.offset, upload_session.length))
+    record = upload_session.record
+    digest = hash_file(upload_session.filepath)
+    check_uploaded_wav(record, digest, series_parameters(record.series_uid))
+    save_file(record, upload_session.filepath, digest)
+    record.uploaded_at = datetime.now()
+    db.session.delete(upload_session)
+    db.session.commit()
+    schedule_processing(record)
+    return record.to_dict()
+
+
+@cached_response('recorder', 'series')
 def get_recorders(series_uid=None, created_from=None, created_to=None,
-                  busy=None):
+                  busy=None, with_series=False):
     filters = []
     created_from, created_to = parse_filtering_dates(created_from, created_to)
     if created_from:
@@ -161,17 +598,27 @@ def get_recorders(series_uid=None, created_from=None, created_to=None,
     if created_to:
         filters.append(Recorder.created_at <= created_to)
     if series_uid:
-        filters.append(
-            or_(*[uid in [s.uid for s in Recorder.serieses]
-                  for uid in series_uid])
-        )
+        filters.append(Recorder.serieses.any(Series.uid.in_(series_uid)))
     if busy is not None:
         if busy:
             filters.append(Recorder.current_series_uid != None)
         if not busy:
             filters.append(Recorder.current_series_uid == None)
-    recorders = Recorder.query.filter(and_(*filters))
-    return [r.to_dict() for r in recorders]
+    if not with_series:
+        recorders = Recorder.query.filter(and_(*filters))
+        return [r.to_dict() for r in recorders]
+    rows = db.session.query(Recorder, Series.uid).\
+        outerjoin(Series, Series.recorder_uid == Recorder.uid).\
+        filter(and_(*filters)).\
+        order_by(Recorder.id, Series.id)
+    recorders = OrderedDict()
+    for recorder, uid in rows:
+        if recorder.uid not in recorders:
+            recorders[recorder.uid] = recorder.to_dict()
+            recorders[recorder.uid]['series_uids'] = []
+        if uid is not None:
+            recorders[recorder.uid]['series_uids'].append(uid)
+    return list(recorders.values())
 
 
 def new_recorder():
@@ -209,8 +656,15 @@ def update_recorder(recorder_uid):
 
 
 def get_current_series(recorder_uid):
-    recorder = get_object_or_404(Recorder, recorder_uid)
-    series = get_object_or_404(Series, recorder.current_series_uid)
+    series = Series.query.\
+        join(Recorder, Recorder.current_series_uid == Series.uid).\
+        filter(Recorder.uid == recorder_uid).\
+        options(orm.joinedload(Series.parameters)).\
+        one_or_none()
+    if series is None:
+        get_object_or_404(Recorder, recorder_uid)
+        flask.abort(404, "Recorder {} has no current series".format(
+            recorder_uid))
     return series.to_dict()
 
 
@@ -233,56 +687,56 @@ def set_current_series(recorder_uid, series_uid=None):
         flask.abort(400, str(ex))
 
 
-def get_serieses(recorder_uid=None, parameters_uid=None, created_from=None,
-                 created_to=None, duration=None, samplerate=None,
-                 channels=None, amplification=None):
-    parameters_filters = []
+def filter_serieses(recorder_uid=None, parameters_uid=None,
+                    created_from=None, created_to=None, duration=None,
+                    samplerate=None, channels=None, amplification=None):
+    """Builds single query of serieses matching filters of GET /series,
+    joined with their recording parameters.
+    """
+    filters = []
     if samplerate:
-        parameters_filters.append(
-            or_(*[RecordingParameters.samplerate == s for s in samplerate])
-        )
+        filters.append(RecordingParameters.samplerate.in_(samplerate))
     if channels:
-        parameters_filters.append(
-            or_(*[RecordingParameters.channels == c for c in channels])
-        )
+        filters.append(RecordingParameters.channels.in_(channels))
     if duration:
-        parameters_filters.append(
+        filters.append(
             or_(*[RecordingParameters.duration >= d for d in duration])
         )
-        parameters_filters.append(
+        filters.append(
             or_(*[RecordingParameters.duration < increase_last_digit(d)
                   for d in duration])
         )
     if amplification:
-        parameters_filters.append(
+        filters.append(
             or_(*[RecordingParameters.amplification >= a
                   for a in amplification])
         )
-        parameters_filters.append(
+        filters.append(
             or_(*[RecordingParameters.amplification < increase_last_digit(a)
                   for a in amplification])
         )
-    parameters = RecordingParameters.query.filter(and_(*parameters_filters))
-    parameters_uids = [p.to_dict()['uid'] for p in parameters]
-
-    filters = []
     created_from, created_to = parse_filtering_dates(created_from, created_to)
     if created_from:
         filters.append(Series.created_at >= created_from)
     if created_to:
         filters.append(Series.created_at <= created_to)
     if recorder_uid:
-        filters.append(
-            or_(*[Series.recorder_uid == r for r in recorder_uid])
-        )
+        filters.append(Series.recorder_uid.in_(recorder_uid))
     if parameters_uid:
-        parameters_uid = set(parameters_uid).intersection(parameters_uids)
-    else:
-        parameters_uid = parameters_uids
-    filters.append(
-        or_(*[Series.parameters_uid == p for p in parameters_uid])
-    )
-    serieses = Series.query.filter(and_(*filters))
+        filters.append(Series.parameters_uid.in_(parameters_uid))
+    return Series.query.join(Series.parameters).\
+        filter(and_(*filters)).\
+        options(orm.contains_eager(Series.parameters))
+
+
+@coalesced('series', 'recording_parameters')
+@cached_response('series', 'recording_parameters')
+def get_serieses(recorder_uid=None, parameters_uid=None, created_from=None,
+                 created_to=None, duration=None, samplerate=None,
+                 channels=None, amplification=None):
+    serieses = filter_serieses(recorder_uid, parameters_uid, created_from,
+                               created_to, duration, samplerate, channels,
+                               amplification)
     return [s.to_dict() for s in serieses]
 
 
@@ -316,6 +770,52 @@ def get_series(series_uid):
     return get_object_or_404(Series, series_uid).to_dict()
 
 
+def get_series_audio(series_uid, **window):
+    # 'from' is a keyword, so window bounds are passed in keyword arguments
+    get_object_or_404(Series, series_uid)
+    parameters = series_parameters(series_uid)
+    if parameters is None:
+        flask.abort(404, "Series {} has no recording parameters".format(
+            series_uid))
+    if not analysis_available():
+        flask.abort(404, "Audio of series is not available")
+    try:
+        start, stop = parse_time_window(window['from'], window['to'])
+    except ValueError as ex:
+        flask.abort(400, str(ex))
+    # all records of series have its duration, so bounding start time from
+    # both sides keeps scan of (series_uid, start_time) index short
+    records = Record.query.filter(
+        Record.series_uid == series_uid,
+        Record.start_time > start - parameters.duration,
+        Record.start_time < stop,
+        Record.stop_time > start
+    ).order_by(Record.start_time).all()
+    sampwidth = 3 if any((r.bit_depth or 16) > 16 for r in records) else 2
+    frames = int(round((stop - start) * parameters.samplerate))
+    length = 44 + frames * parameters.channels * sampwidth
+    if length > 0xFFFFFFFF:
+        flask.abort(400, "Time window is too long for single WAV file")
+    # files are located once read, as they may be transcoded meanwhile
+    storage = get_storage()
+    segments = [
+        (int(round((r.start_time - start) * parameters.samplerate)),
+         partial(storage.path, r))
+        for r in records if r.is_uploaded()
+    ]
+    response = flask.Response(
+        flask.stream_with_context(stitch_wav(
+            segments, frames, parameters.samplerate, parameters.channels,
+            sampwidth
+        )),
+        mimetype='audio/wav', direct_passthrough=True
+    )
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=series_uid + '.wav')
+    response.content_length = length
+    return response
+
+
 def update_series(series_uid):
     series = get_object_or_404(Series, series_uid)
     series_data = request.get_json()
@@ -345,12 +845,17 @@ def delete_series(series_uid):
     if series.recorder.current_series_uid == series.uid:
         flask.abort(400, "Cannot delete currently maintanded series")
     db.session.delete(series)
+    db.session.commit()
     return (f'Series {series_uid} deleted', 204)
 
 
 def get_series_parameters(series_uid):
-    series = get_object_or_404(Series, series_uid)
-    return series.parameters.to_dict()
+    parameters = series_parameters(series_uid)
+    if parameters is None:
+        get_object_or_404(Series, series_uid)
+        flask.abort(404, "Series {} has no recording parameters".format(
+            series_uid))
+    return parameters._asdict()
 
 
 def update_series_parameters(series_uid):
@@ -373,3 +878,10 @@ def update_series_parameters(series_uid):
         flask.abort(400, str(ex))
     except ValueError as ex:
         flask.abort(400, str(ex))
+
+
+def get_metrics():
+    flights = get_single_flight()
+    stats = dict(flights.stats) if flights is not None else \
+        {'executed': 0, 'coalesced': 0, 'timed_out': 0}
+    return {'coalescing': stats}
@@ -1,13 +1,23 @@
+import time
 import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 from flask import current_app as app
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import event, orm
+from sqlalchemy.orm import attributes
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import validates
 from sqlalchemy.sql import select
 
+from .cache import bump_table_version, VersionedCache
 from .helpers import get_object
+from .storage import (
+    ContentAddressedStorage, FileSystemStorage, get_storage, move_into_layout,
+    settle_layout, SIDECAR_SUFFIXES, SUFFIXES
+)
 
 db = SQLAlchemy()
 
@@ -44,6 +54,15 @@ def create_labels(*args, **kwargs):
 
 class Record(db.Model):
     __tablename__ = 'record'
+    __table_args__ = (
+        db.Index('ix_record_series_uid_start_time_stop_time',
+                 'series_uid', 'start_time', 'stop_time'),
+        db.Index('ix_record_series_uid_uploaded_at',
+                 'series_uid', 'uploaded_at'),
+        db.Index('ix_record_label_uid_start_time', 'label_uid', 'start_time'),
+        db.Index('ix_record_start_time_id', 'start_time', 'id'),
+        db.Index('ix_record_checksum', 'checksum'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     uid = db.Column(db.String(36), unique=True, nullable=False,
@@ -51,7 +70,16 @@ class Record(db.Model):
     created_at = db.Column(db.DateTime, default=db.func.now())
     start_time = db.Column(db.Numeric(precision=17, scale=7, asdecimal=False),
                            nullable=False)
+    # duration and stop_time are copied from series recording parameters
+    # by set_record_stop_time, so that time filtering can use an index
+    duration = db.Column(db.Numeric(precision=13, scale=7, asdecimal=False))
+    stop_time = db.Column(db.Numeric(precision=17, scale=7, asdecimal=False))
     uploaded_at = db.Column(db.DateTime)
+    checksum = db.Column(db.String(64))
+    size = db.Column(db.BigInteger)
+    # parsed from header of uploaded WAV file
+    frames = db.Column(db.BigInteger)
+    bit_depth = db.Column(db.Integer)
 
     series_uid = db.Column(db.String(36), db.ForeignKey('series.uid'),
                            nullable=False)
@@ -61,26 +89,20 @@ class Record(db.Model):
                           nullable=True, default=None)
     label = db.relationship("Label", back_populates="records")
 
-    @hybrid_property
-    def filepath(self):
-        filename = str(self.uid) + ".wav"
-        return app.config["UPLOADS_DEFAULT_DEST"] / \
-            str(self.series.uid) / \
-            filename
+    upload_sessions = db.relationship("UploadSession",
+                                      back_populates="record",
+                                      cascade="all, delete-orphan")
 
-    @hybrid_property
-    def stop_time(self):
-        return self.start_time + self.series.parameters.duration
+    @property
+    def filepath(self):
+        return get_storage().path(self)
 
-    @stop_time.expression
-    def stop_time(cls):
-        return select([cls.start_time + RecordingParameters.duration]).\
-            where(RecordingParameters.uid == Series.parameters_uid).\
-            where(Series.uid == cls.series_uid).\
-            as_scalar()
+    @property
+    def filename(self):
+        return str(self.uid) + ".wav"
 
     def is_uploaded(self):
-        return self.uploaded_at is not None and self.filepath.exists()
+        return self.uploaded_at is not None and get_storage().exists(self)
 
     def to_dict(self):
         return {
@@ -90,10 +112,36 @@ class Record(db.Model):
             'label_uid': self.label_uid,
             'start_time': self.start_time,
             'stop_time': self.stop_time,
-            'uploaded_at': self.uploaded_at
+            'duration': self.duration,
+            'uploaded_at': self.uploaded_at,
+            'checksum': self.checksum,
+            'size': self.size,
+            'frames': self.frames,
+            'bit_depth': self.bit_depth
         }
 
 
+def series_duration(connection, series_uid, uncommitted=True):
+    parameters = series_parameters(series_uid, connection, uncommitted)
+    return None if parameters is None else parameters.duration
+
+
+@event.listens_for(Record, 'before_insert')
+@event.listens_for(Record, 'before_update')
+def set_record_stop_time(mapper, connection, target):
+    series_changed = attributes.get_history(target, 'series_uid').\
+        has_changes()
+    if target.duration is None or series_changed:
+        target.duration = series_duration(
+            connection, target.series_uid,
+            parameters_changed(orm.object_session(target))
+        )
+    if target.duration is None:
+        target.stop_time = None
+    else:
+        target.stop_time = target.start_time + target.duration
+
+
 class Recorder(db.Model):
     __tablename__ = 'recorder'
 
@@ -217,7 +265,7 @@ class Series(db.Model):
         return {
             'uid': self.uid,
             'created_at': self.created_at,
-            'recorder_uid': self.recorder.uid,
+            'recorder_uid': self.recorder_uid,
             'description': self.description,
             'parameters_uid': self.parameters_uid,
             'parameters': self.parameters.to_dict()
@@ -225,8 +273,257 @@ class Series(db.Model):
         }
 
 
+def invalidate_on_commit(session, invalidate, *keys):
+    """Calls invalidate with every key once session is committed."""
+    if session is not None:
+        session.info.setdefault('invalidated', set()).update(
+            (invalidate, key) for key in keys if key is not None
+        )
+
+
+def tables_changed(session, *tables):
+    """Marks tables written by session other than through ORM objects, so
+    their versions change once session is committed.
+    """
+    invalidate_on_commit(session, bump_table_version, *tables)
+
+
+@event.listens_for(Label, 'after_insert')
+@event.listens_for(Label, 'after_update')
+@event.listens_for(Label, 'after_delete')
+@event.listens_for(RecordingParameters, 'after_insert')
+@event.listens_for(RecordingParameters, 'after_update')
+@event.listens_for(RecordingParameters, 'after_delete')
+@event.listens_for(Series, 'after_insert')
+@event.listens_for(Series, 'after_update')
+@event.listens_for(Series, 'after_delete')
+@event.listens_for(Recorder, 'after_insert')
+@event.listens_for(Recorder, 'after_update')
+@event.listens_for(Recorder, 'after_delete')
+@event.listens_for(Record, 'after_insert')
+@event.listens_for(Record, 'after_update')
+@event.listens_for(Record, 'after_delete')
+def table_changed(mapper, connection, target):
+    tables_changed(orm.object_session(target), mapper.local_table.name)
+
+
+@event.listens_for(orm.Session, 'before_flush')
+def mark_parameters_changed(session, flush_context, instances):
+    # so records flushed along with them do not use cached parameters
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, (Series, RecordingParameters)):
+            tables_changed(session, obj.__table__.name)
+
+
+def parameters_changed(session):
+    """Returns True if session changed series or recording parameters,
+    which are not committed yet.
+    """
+    invalidated = session.info.get('invalidated', ()) if session else ()
+    return any((bump_table_version, table) in invalidated
+               for table in parameters_cache.tables)
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def invalidate_committed(session):
+    # cached entries are dropped only once change is visible to requests
+    # loading them again
+    for invalidate, key in session.info.pop('invalidated', ()):
+        invalidate(key)
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def forget_invalidated(session):
+    session.info.pop('invalidated', None)
+
+
+labels_cache = VersionedCache(['label'])
+parameters_cache = VersionedCache(['series', 'recording_parameters'])
+
+# recording parameters of series, as returned by series_parameters
+SeriesParameters = namedtuple('SeriesParameters', [
+    'uid', 'created_at', 'samplerate', 'channels', 'duration', 'amplification'
+])
+
+
+def all_labels():
+    """Returns dict of all labels by uid, cached until label is changed."""
+    return labels_cache.get('all', lambda: {
+        label.uid: label.to_dict() for label in Label.query
+    })
+
+
+def series_parameters(series_uid, connection=None, uncommitted=False):
+    """Returns SeriesParameters of series, or None if there is no such
+    series. They are cached until any series or parameters are changed.
+    Parameters changed by uncommitted transaction of given connection are
+    queried directly, as cache does not see them until they are committed.
+    """
+    def load():
+        table = RecordingParameters.__table__
+        row = (connection or db.session).execute(
+            select([table.c[field] for field in SeriesParameters._fields]).
+            where(table.c.uid == Series.parameters_uid).
+            where(Series.uid == series_uid)
+        ).first()
+        return None if row is None else SeriesParameters(*row)
+
+    if uncommitted:
+        return load()
+    return parameters_cache.get(series_uid, load)
+
+
+class UploadSession(db.Model):
+    __tablename__ = 'upload_session'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    uid = db.Column(db.String(36), unique=True, nullable=False,
+                    default=uuid.uuid4)
+    created_at = db.Column(db.DateTime, default=db.func.now())
+    updated_at = db.Column(db.DateTime, default=db.func.now(),
+                           onupdate=db.func.now())
+    length = db.Column(db.BigInteger, nullable=True)
+
+    record_uid = db.Column(db.String(36), db.ForeignKey('record.uid'),
+                           nullable=False)
+    record = db.relationship("Record", back_populates="upload_sessions")
+
+    @hybrid_property
+    def filepath(self):
+        return app.config["UPLOADS_DEFAULT_DEST"] / ".incoming" / \
+            (str(self.uid) + ".upload")
+
+    @property
+    def offset(self):
+        try:
+            return self.filepath.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def expires_at(self):
+        return self.updated_at + \
+            timedelta(seconds=app.config["UPLOAD_SESSION_TTL"])
+
+    def is_expired(self):
+        return self.expires_at < datetime.now()
+
+    def to_dict(self):
+        return {
+            'uid': self.uid,
+            'record_uid': self.record_uid,
+            'created_at': self.created_at,
+            'expires_at': self.expires_at,
+            'offset': self.offset,
+            'length': self.length
+        }
+
+
+def remove_expired_upload_sessions():
+    """Deletes upload sessions, that were not touched for longer than
+    UPLOAD_SESSION_TTL, together with their partial files. Returns number
+    of removed sessions.
+    """
+    expired_before = datetime.now() - \
+        timedelta(seconds=app.config["UPLOAD_SESSION_TTL"])
+    sessions = UploadSession.query.\
+        filter(UploadSession.updated_at < expired_before).all()
+    for upload_session in sessions:
+        if upload_session.filepath.exists():
+            upload_session.filepath.unlink()
+        db.session.delete(upload_session)
+    db.session.commit()
+    return len(sessions)
+
+
+def remove_unreferenced_blobs():
+    """Removes blobs of content addressed storage, that are not referenced
+    by checksum of any record and were not touched for MEDIA_GC_GRACE_PERIOD.
+    Returns number of removed blobs.
+    """
+    storage = ContentAddressedStorage()
+    unused_since = time.time() - app.config["MEDIA_GC_GRACE_PERIOD"]
+    removed = 0
+    for names in storage.blobs():
+        checksums = {name.split('.')[0] for name in names}
+        referenced = {checksum for checksum, in db.session.query(
+            Record.checksum).filter(Record.checksum.in_(checksums))}
+        for name in names:
+            if name.split('.')[0] not in referenced:
+                removed += storage.remove_blob(name, unused_since)
+    return removed
+
+
+def relayout_record_files(workers, restart=False):
+    """Moves files of uploaded records into MEDIA_LAYOUT of filesystem
+    storage, renaming them in parallel in batches of records ordered by id.
+    Id of last finished batch is saved, so interrupted relayout resumes from
+    there. Once it finishes, files are looked up in MEDIA_LAYOUT only.
+    Returns number of moved files.
+    """
+    storage = FileSystemStorage()
+    checkpoint = app.config["UPLOADS_DEFAULT_DEST"] / \
+        ".relayout-{}".format(app.config["MEDIA_LAYOUT"])
+    last_id = 0
+    if checkpoint.exists() and not restart:
+        last_id = int(checkpoint.read_text())
+    batch_size = app.config["RECORDS_STREAM_BATCH_SIZE"]
+    moved = 0
+    with ThreadPoolExecutor(workers) as executor:
+        while True:
+            records = Record.query.\
+                filter(Record.id > last_id, Record.uploaded_at != None).\
+                order_by(Record.id).limit(batch_size).all()
+            if not records:
+                break
+            moved += sum(executor.map(move_into_layout, [
+                storage.paths(r, suffix)
+                for r in records for suffix in SUFFIXES + SIDECAR_SUFFIXES
+            ]))
+            last_id = records[-1].id
+            checkpoint.write_text(str(last_id))
+            db.session.expunge_all()
+    checkpoint.unlink()
+    settle_layout()
+    return moved
+
+
 @event.listens_for(Series, 'after_insert')
 def create_series_folder(mapper, connection, target):
     series_uid = target.uid
     p = app.config["UPLOADS_DEFAULT_DEST"] / str(series_uid)
     p.mkdir(exist_ok=True)
+
+
+def update_records_duration(connection, series_filter, duration):
+    records = Record.__table__
+    connection.execute(
+        records.update().
+        where(series_filter).
+        values(duration=duration,
+               stop_time=records.c.start_time + duration)
+    )
+
+
+@event.listens_for(Series, 'after_update')
+def update_series_records_duration(mapper, connection, target):
+    if attributes.get_history(target, 'parameters_uid').has_changes():
+        tables_changed(orm.object_session(target), 'record')
+        update_records_duration(
+            connection, Record.series_uid == target.uid,
+            series_duration(connection, target.uid)
+        )
+
+
+@event.listens_for(RecordingParameters, 'after_update')
+def update_parameters_records_duration(mapper, connection, target):
+    if attributes.get_history(target, 'duration').has_changes():
+        tables_changed(orm.object_session(target), 'record')
+        update_records_duration(
+            connection,
+            Record.series_uid.in_(
+                select([Series.uid]).
+                where(Series.parameters_uid == target.uid)
+            ),
+            target.duration
+        )
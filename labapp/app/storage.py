@@ -0,0 +1,635 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import flask
+from flask import current_app as app, request
+from werkzeug.wsgi import wrap_file
+
+from . import audio
+
+CHUNK_SIZE = 64 * 1024
+
+
+def incoming_dir():
+    """Returns directory for files being uploaded. It lies inside media
+    directory, so finished uploads can be moved into place atomically.
+    """
+    return app.config["UPLOADS_DEFAULT_DEST"] / ".incoming"
+
+
+class Digest:
+    """SHA-256 checksum, size and WAV header of file, computed from chunks
+    of the file as they pass by.
+    """
+
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.wav = audio.WavHeaderParser()
+
+    @property
+    def checksum(self):
+        return self.hash.hexdigest()
+
+    def update(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.wav.feed(data)
+
+
+class HashingFile:
+    """Temporary file in incoming directory, that computes digest of its
+    content while it is being written.
+    """
+
+    def __init__(self, directory=None):
+        directory = directory or incoming_dir()
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, self.name = tempfile.mkstemp(dir=str(directory), suffix='.part')
+        self.file = os.fdopen(fd, 'w+b')
+        self.digest = Digest()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    @property
+    def checksum(self):
+        return self.digest.checksum
+
+    @property
+    def size(self):
+        return self.digest.size
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def sync(self):
+        """Durably writes content and closes file, so it can be moved into
+        storage.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def close(self):
+        self.file.close()
+        try:
+            os.unlink(self.name)
+        except FileNotFoundError:
+            pass
+
+
+class UploadRequest(flask.Request):
+    """Request, that streams uploaded files straight into hashing temporary
+    files in media directory instead of spooling them separately.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return HashingFile()
+
+
+def hashing_upload(file):
+    """Returns HashingFile holding content of uploaded file, so its checksum
+    is known before the file is stored.
+    """
+    if not isinstance(file.stream, HashingFile):
+        upload = HashingFile()
+        shutil.copyfileobj(file.stream, upload, CHUNK_SIZE)
+        file.stream = upload
+    return file.stream
+
+
+@contextmanager
+def record_lock(record):
+    """Serializes replacing of stored file of record among threads and
+    processes. Records share 256 lock files, so they do not pile up.
+    """
+    directory = app.config["UPLOADS_DEFAULT_DEST"] / ".locks"
+    directory.mkdir(parents=True, exist_ok=True)
+    name = hashlib.sha256(str(record.uid).encode()).hexdigest()[:2]
+    with open(str(directory / name), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def save_upload(record, file):
+    """Moves uploaded file into storage and stores its checksum and size on
+    record.
+    """
+    upload = hashing_upload(file)
+    try:
+        upload.sync()
+        record.checksum = upload.checksum
+        record.size = upload.size
+        with record_lock(record):
+            get_storage().store(record, upload.name)
+    finally:
+        upload.close()
+
+
+def hash_file(path):
+    """Returns digest of file, reading it in chunks."""
+    digest = Digest()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+def write_chunk(path, offset, data):
+    """Durably writes data at given offset of partially uploaded file and
+    returns new size of the file. Offset must be equal to current size.
+    """
+    with open(str(path), 'r+b' if path.exists() else 'wb') as f:
+        f.seek(offset)
+        f.write(data)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def save_file(record, path, digest):
+    """Moves complete file at given path into storage and stores its
+    checksum and size on record.
+    """
+    record.checksum, record.size = digest.checksum, digest.size
+    with record_lock(record):
+        get_storage().store(record, path)
+
+
+def flat_layout(record):
+    return ()
+
+
+def date_layout(record):
+    return datetime.utcfromtimestamp(record.start_time).\
+        strftime('%Y/%m/%d').split('/')
+
+
+def uid_layout(record):
+    uid = str(record.uid)
+    return uid[:2], uid[2:4]
+
+
+LAYOUTS = {
+    'flat': flat_layout,
+    'date': date_layout,
+    'uid': uid_layout,
+}
+SUFFIXES = ('.wav', '.flac')
+# files derived from record file and stored next to it
+SIDECAR_SUFFIXES = ('.peaks', '.riff')
+BLOB_SUFFIXES = ('', '.flac')
+
+
+def layout_marker():
+    return app.config["UPLOADS_DEFAULT_DEST"] / ".layout"
+
+
+# stamp and content of layout marker last read by this process
+settled_layout = (None, None)
+
+
+def relayout_pending():
+    """Returns True unless relayout finished moving files into MEDIA_LAYOUT,
+    as recorded by layout marker. Marker is read again only once its stamp
+    changes, so the check costs single stat call.
+    """
+    global settled_layout
+    try:
+        stat = layout_marker().stat()
+    except FileNotFoundError:
+        return True
+    stamp = (stat.st_ino, stat.st_mtime_ns)
+    if settled_layout[0] != stamp:
+        settled_layout = (stamp, layout_marker().read_text())
+    return settled_layout[1] != app.config["MEDIA_LAYOUT"]
+
+
+def settle_layout():
+    """Records, that all files are laid out by MEDIA_LAYOUT."""
+    replace_file(layout_marker(), lambda name: Path(name).write_text(
+        app.config["MEDIA_LAYOUT"]))
+
+
+class FileSystemStorage:
+    """Stores file of every record as <record_uid>.wav (or .flac, once
+    transcoded) in its series directory, sharded into subdirectories by
+    MEDIA_LAYOUT. Until relayout moves existing files, files laid out by
+    other layouts are still found, so layout can be changed first.
+    """
+
+    def layout_path(self, record, layout, suffix='.wav'):
+        return app.config["UPLOADS_DEFAULT_DEST"] / str(record.series_uid) / \
+            Path(*LAYOUTS[layout](record)) / (str(record.uid) + suffix)
+
+    def paths(self, record, suffix='.wav'):
+        """Returns path of record file in configured layout followed by its
+        paths in other layouts.
+        """
+        layout = app.config["MEDIA_LAYOUT"]
+        return [self.layout_path(record, layout, suffix)] + [
+            self.layout_path(record, other, suffix)
+            for other in LAYOUTS if other != layout
+        ]
+
+    def all_paths(self, record):
+        return [path for suffix in SUFFIXES
+                for path in self.paths(record, suffix)]
+
+    def lookup_paths(self, record):
+        """Returns paths of record file in configured layout, followed by
+        its paths in other layouts while relayout is pending.
+        """
+        layout = app.config["MEDIA_LAYOUT"]
+        paths = [self.layout_path(record, layout, suffix)
+                 for suffix in SUFFIXES]
+        if relayout_pending():
+            paths += [self.layout_path(record, other, suffix)
+                      for other in LAYOUTS if other != layout
+                      for suffix in SUFFIXES]
+        return paths
+
+    def path(self, record):
+        paths = self.lookup_paths(record)
+        for path in paths:
+            if path.exists():
+                return path
+        return paths[0]
+
+    def exists(self, record):
+        return any(path.exists() for path in self.lookup_paths(record))
+
+    def sidecar_paths(self, record):
+        return [path for suffix in SIDECAR_SUFFIXES
+                for path in self.paths(record, suffix)]
+
+    def store(self, record, path, suffix='.wav'):
+        target = self.paths(record, suffix)[0]
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(str(path), str(target))
+        others = self.all_paths(record)
+        if suffix == '.wav':
+            # new content, files derived from previous one are stale
+            others += self.sidecar_paths(record) + features_paths(record)
+        for other in others:
+            if other != target:
+                remove_file(other)
+
+    def delete(self, record):
+        for path in self.all_paths(record) + self.sidecar_paths(record) + \
+                features_paths(record):
+            remove_file(path)
+
+
+def move_into_layout(paths):
+    """Moves file found at any of other paths to the first path, unless it
+    is already there. Returns True if file was moved.
+    """
+    target, *others = paths
+    for other in others:
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # unlike rename, linking does not replace file stored meanwhile
+            os.link(str(other), str(target))
+        except FileNotFoundError:
+            continue
+        except FileExistsError:
+            return False
+        remove_file(other)
+        return True
+    return False
+
+
+def remove_file(path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class ContentAddressedStorage:
+    """Stores record files as blobs named by their SHA-256 checksum in
+    sharded .blobs directory, so identical files are stored once. Blob is
+    referenced by every record row having its checksum; blobs left without
+    references are removed lazily by remove_unreferenced_blobs. Files stored
+    by FileSystemStorage before switching are still found.
+    """
+
+    fallback = FileSystemStorage()
+
+    @staticmethod
+    def blobs_dir():
+        return app.config["UPLOADS_DEFAULT_DEST"] / ".blobs"
+
+    def blob_path(self, checksum, suffix=''):
+        return self.blobs_dir() / checksum[:2] / checksum[2:4] / \
+            (checksum + suffix)
+
+    def blob_paths(self, checksum):
+        return [self.blob_path(checksum, suffix) for suffix in BLOB_SUFFIXES]
+
+    def path(self, record):
+        if record.checksum:
+            for blob in self.blob_paths(record.checksum):
+                if blob.exists():
+                    return blob
+        return self.fallback.path(record)
+
+    def exists(self, record):
+        return self.path(record).exists()
+
+    def store(self, record, path, suffix='.wav'):
+        existing = [blob for blob in self.blob_paths(record.checksum)
+                    if blob.exists()]
+        if suffix == '.wav' and existing:
+            # refresh blob, so garbage collection running concurrently with
+            # this upload leaves it in place
+            os.utime(str(existing[0]))
+            os.unlink(str(path))
+        else:
+            blob = self.blob_path(record.checksum,
+                                  '' if suffix == '.wav' else suffix)
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(str(path), str(blob))
+            for other in existing:
+                if other != blob:
+                    remove_file(other)
+        if suffix == '.wav':
+            self.fallback.delete(record)
+        else:
+            # features of transcoded content stay valid
+            for path in self.fallback.all_paths(record) + \
+                    self.fallback.sidecar_paths(record):
+                remove_file(path)
+
+    def delete(self, record):
+        # blob is removed by garbage collection once no record references it
+        self.fallback.delete(record)
+
+    def blobs(self):
+        """Yields lists of names of stored blobs (checksum with optional
+        suffix), one list per shard directory.
+        """
+        for shard in sorted(self.blobs_dir().glob('*/*')):
+            yield [blob.name for blob in shard.iterdir()]
+
+    def remove_blob(self, name, unused_since):
+        """Removes blob, if it was not modified since given timestamp.
+        Returns True if blob was removed.
+        """
+        blob = self.blob_path(name)
+        try:
+            if blob.stat().st_mtime >= unused_since:
+                return False
+            blob.unlink()
+            return True
+        except FileNotFoundError:
+            return False
+
+
+STORAGES = {
+    'filesystem': FileSystemStorage,
+    'content-addressed': ContentAddressedStorage,
+}
+
+
+def get_storage():
+    """Returns storage backend chosen by MEDIA_STORAGE setting."""
+    return STORAGES[app.config["MEDIA_STORAGE"]]()
+
+
+def transcode_to_flac(record):
+    """Replaces stored WAV file of record with its lossless FLAC encoding.
+    Chunks of WAV file other than samples are kept in .riff file next to
+    it, so decoded file is identical to uploaded one. Returns True if file
+    was transcoded.
+    """
+    if not audio.flac_available():
+        return False
+    storage = get_storage()
+    source = storage.path(record)
+    if source.suffix == '.flac' or not source.exists() or \
+            not audio.can_encode_flac(source):
+        return False
+    stat = source.stat()
+    directory = incoming_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    fd, name = tempfile.mkstemp(dir=str(directory), suffix='.flac')
+    os.close(fd)
+    try:
+        audio.encode_flac(source, name)
+        with open(name, 'rb') as f:
+            os.fsync(f.fileno())
+        riff = audio.split_wav(source)
+        if audio.decoded_wav_length(name, riff) != stat.st_size:
+            # samples are not all that lies between chunks
+            return False
+        with record_lock(record):
+            if not unchanged(source, stat):
+                # file was uploaded again while being transcoded
+                return False
+            storage.store(record, name, '.flac')
+            replace_file(storage.path(record).with_suffix('.riff'),
+                         lambda path: audio.write_riff(path, *riff))
+        return True
+    finally:
+        remove_file(Path(name))
+
+
+def sidecar_path(record, suffix):
+    """Returns path of file derived from record file, lying next to it.
+    Content addressed storage shares it among records with the same file.
+    """
+    return get_storage().path(record).with_suffix(suffix)
+
+
+def unchanged(path, stat):
+    """Returns True if file at path is still the one of given stat result,
+    i.e. it was neither removed nor uploaded again.
+    """
+    try:
+        current = path.stat()
+    except FileNotFoundError:
+        return False
+    return (current.st_ino, current.st_mtime_ns) == \
+        (stat.st_ino, stat.st_mtime_ns)
+
+
+def replace_file(path, write, source=None):
+    """Calls write with path of temporary file in incoming directory and
+    atomically moves written file to given path. If stat result of source
+    file is given, written file is discarded once source file changed.
+    Returns True if file was moved.
+    """
+    directory = incoming_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    fd, name = tempfile.mkstemp(dir=str(directory), suffix=path.suffix)
+    os.close(fd)
+    try:
+        write(name)
+        if source is not None and not unchanged(*source):
+            return False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(name, str(path))
+        return True
+    finally:
+        remove_file(Path(name))
+
+
+def save_peaks(record):
+    """Computes peak envelope of record file and stores it next to the
+    file. Returns path of peaks file, or None if record file was replaced
+    meanwhile.
+    """
+    source = record.filepath
+    stat = source.stat()
+    path = source.with_suffix('.peaks')
+    samplerate, frames, levels = audio.compute_peaks(source)
+    if replace_file(path, lambda name: audio.write_peaks(
+        name, samplerate, frames, levels
+    ), (source, stat)):
+        return path
+    return None
+
+
+def features_dir():
+    return app.config["UPLOADS_DEFAULT_DEST"] / ".features"
+
+
+def features_config(**options):
+    """Returns feature configuration made of FEATURES setting overridden by
+    given options, which are not None.
+    """
+    config = dict(app.config["FEATURES"])
+    config.update((key, value) for key, value in options.items()
+                  if value is not None)
+    if config['kind'] != 'log-mel':
+        # so it does not tell apart files of identical features
+        config.pop('n_mels', None)
+    return config
+
+
+def check_features_config(config):
+    """Raises ValueError if windows of configuration overlap so much, that
+    features would be many times larger than audio file.
+    """
+    if config['hop_length'] < config['n_fft'] // 4:
+        raise ValueError("hop_length must be at least quarter of n_fft")
+
+
+def features_key(config):
+    """Returns hash of feature configuration and version of algorithm, that
+    names directory of features computed with them.
+    """
+    data = json.dumps(dict(config, version=audio.FEATURES_VERSION),
+                      sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def features_path(record, config):
+    return features_dir() / features_key(config) / (record.uid + '.npy')
+
+
+def features_paths(record):
+    """Returns paths of features of record computed with any
+    configuration.
+    """
+    return list(features_dir().glob('*/{}.npy'.format(record.uid)))
+
+
+def write_features(source, target, config):
+    """Computes features of audio file at source path and atomically writes
+    them to target .npy file. Features of file replaced meanwhile are
+    discarded. Returns True if features were written. Application context
+    is not needed, so it runs in worker processes as well.
+    """
+    stat = source.stat()
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, name = tempfile.mkstemp(dir=str(target.parent), suffix='.part')
+    os.close(fd)
+    try:
+        audio.write_features(name, *audio.compute_features(source, **config))
+        if not unchanged(source, stat):
+            return False
+        os.replace(name, str(target))
+        return True
+    finally:
+        remove_file(Path(name))
+
+
+def offload_file(path, attachment_filename, mimetype='audio/wav'):
+    """Returns empty response, that lets front proxy serve file at given path
+    itself, including handling of range requests.
+    """
+    response = app.response_class(mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=attachment_filename)
+    if app.config['DOWNLOAD_OFFLOAD'] == 'x-accel-redirect':
+        relative = path.relative_to(app.config["UPLOADS_DEFAULT_DEST"])
+        response.headers['X-Accel-Redirect'] = \
+            app.config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + \
+            relative.as_posix()
+    else:
+        response.headers['X-Sendfile'] = str(path)
+    return response
+
+
+def send_file(path, attachment_filename, mimetype='audio/wav'):
+    """Sends file at given path as attachment, answering conditional and
+    Range/If-Range requests. Depending on DOWNLOAD_OFFLOAD setting, bytes are
+    sent by front proxy or by WSGI server's file wrapper, so gunicorn can use
+    zero-copy os.sendfile for whole files as well as for ranges. Other
+    servers get ranges through werkzeug's iterator.
+    """
+    if app.config['DOWNLOAD_OFFLOAD']:
+        return offload_file(path, attachment_filename, mimetype)
+    response = flask.send_file(str(path), mimetype=mimetype,
+                               as_attachment=True,
+                               attachment_filename=attachment_filename,
+                               conditional=True)
+    response.headers.setdefault('Accept-Ranges', 'bytes')
+    if response.status_code == 206 and \
+            'wsgi.file_wrapper' in request.environ and \
+            request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn'):
+        # werkzeug serves ranges through its own iterator, which hides file
+        # from server; gunicorn sends no more than Content-Length of range,
+        # so seeked file is sent by its file wrapper the same way as whole
+        # file, while other servers may send file up to its end
+        file = open(str(path), 'rb')
+        file.seek(response.content_range.start)
+        response.response.close()
+        response.response = wrap_file(request.environ, file)
+    return response
+
+
+def send_decoded_wav(path, attachment_filename):
+    """Sends WAV file decoded on the fly from FLAC file at given path,
+    answering Range/If-Range requests. Chunks of uploaded file kept next to
+    FLAC file are sent along, otherwise samples get canonical header.
+    """
+    riff = audio.read_riff(path.with_suffix('.riff'))
+    response = app.response_class(audio.decode_flac(path, riff),
+                                  mimetype='audio/wav',
+                                  direct_passthrough=True)
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=attachment_filename)
+    response.content_length = audio.decoded_wav_length(path, riff)
+    response.last_modified = path.stat().st_mtime
+    return response.make_conditional(
+        request, accept_ranges=True,
+        complete_length=response.content_length
+    )
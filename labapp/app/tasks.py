@@ -0,0 +1,124 @@
+"""Jobs run in background threads of worker process, outside of requests
+that scheduled them.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+
+from flask import current_app as app
+
+from . import audio
+from .dataset import error_path, export_key, export_records
+from .models import db, Record
+from .storage import (
+    features_path, save_peaks, transcode_to_flac, write_features
+)
+
+executor = None
+
+
+def get_executor():
+    # created lazily, so every forked worker process gets its own threads
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(app.config["BACKGROUND_WORKERS"])
+    return executor
+
+
+def wait_for_background_jobs():
+    """Waits until all scheduled jobs are finished."""
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=True)
+        executor = None
+
+
+def run_in_background(func, *args):
+    """Runs func with given arguments in application context of background
+    thread. Failures are logged.
+    """
+    flask_app = app._get_current_object()
+
+    def run():
+        with flask_app.app_context():
+            try:
+                func(*args)
+            except Exception:
+                flask_app.logger.exception(
+                    "Background job %s%r failed", func.__name__, args
+                )
+
+    return get_executor().submit(run)
+
+
+def process_upload(record_uid):
+    """Computes files derived from newly uploaded record file, then
+    transcodes it to FLAC if enabled.
+    """
+    record = Record.query.filter_by(uid=record_uid).one_or_none()
+    if record is None or not record.is_uploaded():
+        return
+    if audio.analysis_available():
+        save_peaks(record)
+    if app.config["MEDIA_FLAC"]:
+        transcode_to_flac(record)
+
+
+def schedule_processing(record):
+    run_in_background(process_upload, record.uid)
+
+
+def transcode_records(workers):
+    """Transcodes files of all uploaded records still stored as WAV, in
+    parallel in batches of records ordered by id. Returns number of
+    transcoded files.
+    """
+    flask_app = app._get_current_object()
+
+    def transcode(record):
+        with flask_app.app_context():
+            return transcode_to_flac(record)
+
+    batch_size = app.config["RECORDS_STREAM_BATCH_SIZE"]
+    last_id = 0
+    transcoded = 0
+    with ThreadPoolExecutor(workers) as pool:
+        while True:
+            records = Record.query.\
+                filter(Record.id > last_id, Record.uploaded_at != None).\
+                order_by(Record.id).limit(batch_size).all()
+            if not records:
+                break
+            transcoded += sum(pool.map(transcode, records))
+            last_id = records[-1].id
+            db.session.expunge_all()
+    return transcoded
+
+
+def compute_series_features(series_uid, workers, config):
+    """Computes missing features of uploaded records of series in pool of
+    worker processes, as NumPy releases GIL only for parts of computation.
+    Returns number of computed files.
+    """
+    records = Record.query.\
+        filter(Record.series_uid == series_uid, Record.uploaded_at != None).\
+        order_by(Record.id).all()
+    sources, targets = [], []
+    for record in records:
+        target = features_path(record, config)
+        if not target.exists():
+            sources.append(record.filepath)
+            targets.append(target)
+    with ProcessPoolExecutor(workers) as pool:
+        return sum(pool.map(write_features, sources, targets, repeat(config),
+                            chunksize=8))
+
+
+def update_export(filters, query):
+    """Exports records of query returned by given function to export
+    identified by filters. Failure is kept in export directory, so it is
+    reported when export is requested.
+    """
+    try:
+        export_records(filters, query())
+    except ValueError as ex:
+        error_path(export_key(filters)).write_text(str(ex))
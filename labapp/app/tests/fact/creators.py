@@ -1,4 +1,7 @@
+import os
 import random
+import wave
+from io import BytesIO
 from time import time
 
 from ..fact import fake
@@ -49,3 +52,15 @@ def create_series(uid=None, description=None, recorder_uid=None,
         'recorder_uid': recorder_uid or create_recorder()[0]["uid"],
         'parameters': parameters or create_recording_parameters()[0]
     }
+
+
+def create_wav(samplerate=44100, channels=1, duration=1.0, sampwidth=2):
+    """Returns content of PCM WAV file filled with random noise."""
+    frames = int(round(samplerate * duration))
+    content = BytesIO()
+    with wave.open(content, 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(sampwidth)
+        f.setframerate(samplerate)
+        f.writeframes(os.urandom(frames * channels * sampwidth))
+    return content.getvalue()
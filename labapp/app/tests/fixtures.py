@@ -1,8 +1,12 @@
 import pytest
 import shutil
 
+from sqlalchemy import event
+
 from app import create_app
+from app.cache import clear_caches
 from app.models import db
+from app.tasks import wait_for_background_jobs
 
 
 @pytest.yield_fixture(scope='session')
@@ -19,12 +23,29 @@ def database(app):
     db.drop_all()
     db.create_all()
     yield db
+    wait_for_background_jobs()
+    clear_caches()
     db.session.close()
     db.drop_all()
     for i in app.config['UPLOADS_DEFAULT_DEST'].iterdir():
-        shutil.rmtree(i)
+        if i.is_dir():
+            shutil.rmtree(i)
+        else:
+            i.unlink()
 
 
 @pytest.yield_fixture(scope='session')
 def client(app):
     return app.test_client()
+
+
+@pytest.yield_fixture(scope='function')
+def queries(database):
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(database.engine, 'before_cursor_execute', count)
+    yield statements
+    event.remove(database.engine, 'before_cursor_execute', count)
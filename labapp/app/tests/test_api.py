@@ -1,15 +1,28 @@
+import hashlib
 import json
+import os
+import struct
+import tarfile
+import zipfile
 from datetime import datetime, timedelta
 from io import BytesIO
 
+import numpy as np
 import pytest
 
+from app import audio, cache, dataset, labapp_api, storage, tasks
 from app.helpers import (datetime_to_string, datetime_to_time,
                          encode_recorder_key)
+from app.models import (
+    Label, Recorder, relayout_record_files, remove_expired_upload_sessions,
+    remove_unreferenced_blobs, Record, UploadSession
+)
 from app.tests.fact import models, creators
 
 
 BASE_URL = '1.0/lab'
+# matches recording parameters created by RecordingParametersFactory
+WAV = creators.create_wav(samplerate=44100, channels=1, duration=10.0)
 
 NOW = datetime.now()
 DATESTRINGS = {
@@ -40,12 +53,34 @@ def test_adding_labels(app, client):
     assert data['description'] == '2'
 
 
+def test_caching_labels(app, client, database, queries):
+    url = f"{BASE_URL}/label"
+    assert len(json.loads(client.get(url).data)) == 2
+    queries.clear()
+    assert len(json.loads(client.get(url).data)) == 2
+    assert queries == []
+
+    # label added through API is seen at once
+    client.post(url, data=json.dumps(creators.create_label(uid='lab1')),
+                content_type='application/json')
+    assert len(json.loads(client.get(url).data)) == 3
+
+    # other workers announce their changes by version stamp
+    database.session.execute(Label.__table__.insert(), {'uid': 'lab2'})
+    database.session.commit()
+    assert len(json.loads(client.get(url).data)) == 3
+    cache.bump_table_version('label')
+    assert len(json.loads(client.get(url).data)) == 4
+
+
 @pytest.mark.parametrize('attributes,data_len', [
     ({'recorded_from': datetime_to_string(datetime(2018, 11, 15, 12, 0, 13))},
         2),
     ({'recorded_to': datetime_to_string(datetime(2018, 11, 15, 12, 0, 48))},
         3),
     ({'series_uid': 'Series1'}, 3),
+    ({'uploaded': 'true'}, 4),
+    ({'uploaded': 'false'}, 1),
     ({'label': 'normal'}, 2),
     ({'labeled': 'true'}, 4),
     ({'labeled': 'false'}, 1)
@@ -91,6 +126,46 @@ def test_getting_records(app, client, attributes, data_len):
     assert len(data) == data_len
 
 
+@pytest.mark.usefixtures('database')
+def test_paginating_records(app, client):
+    series = models.SeriesFactory.create()
+    start = datetime_to_time(datetime(2018, 11, 15, 12, 0, 0))
+    for i in range(5):
+        models.RecordFactory.create(series=series, start_time=start + i)
+    # two records sharing start time are ordered by id
+    models.RecordFactory.create(series=series, start_time=start + 2)
+    uids = []
+    cursor = None
+    while True:
+        url = f"{BASE_URL}/record?limit=2"
+        if cursor:
+            url += f"&cursor={cursor}"
+        response = client.get(url)
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        uids.extend(r['uid'] for r in data)
+        cursor = response.headers.get('X-Next-Cursor')
+        if cursor is None:
+            break
+    assert len(uids) == 6
+    assert len(set(uids)) == 6
+    response = client.get(f"{BASE_URL}/record?cursor=not-a-cursor")
+    assert response.status_code == 400
+
+
+@pytest.mark.usefixtures('database')
+def test_streaming_records(app, client):
+    series = models.SeriesFactory.create()
+    for i in range(3):
+        models.RecordFactory.create(series=series, start_time=1000.0 + i)
+    response = client.get(f"{BASE_URL}/record?stream=true")
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.data.decode('utf-8').splitlines()
+    assert [json.loads(l)['start_time'] for l in lines] == \
+        [1000.0, 1001.0, 1002.0]
+
+
 @pytest.mark.parametrize('label', [None, 'normal'])
 @pytest.mark.usefixtures('database')
 def test_registering_record(app, client, label):
@@ -146,14 +221,318 @@ def test_registering_record_by_non_existing_recorder(app, client):
     assert response.status_code == 401
 
 
+def test_caching_authenticated_recorder(app, client, database, queries):
+    recorder1 = models.RecorderFactory.create()
+    recorder2 = models.RecorderFactory.create()
+    series = models.SeriesFactory.create(recorder=recorder1)
+
+    keys = [encode_recorder_key(r.uid) for r in (recorder1, recorder2)]
+    series_uid = series.uid
+
+    def register(key, series_uid):
+        return client.post(
+            f"{BASE_URL}/record",
+            data=json.dumps(creators.create_record(series_uid=series_uid)),
+            content_type='application/json',
+            headers={'recorder_key': key}
+        )
+
+    assert register(keys[0], series_uid).status_code == 200
+    queries.clear()
+    assert register(keys[0], series_uid).status_code == 200
+    assert not [q for q in queries if 'recorder' in q]
+    assert register(keys[1], series_uid).status_code == 403
+
+    # cached owner is dropped once series is moved to other recorder
+    series.recorder_uid = recorder2.uid
+    database.session.commit()
+    assert register(keys[1], series_uid).status_code == 200
+    assert register(keys[0], series_uid).status_code == 403
+
+    # other workers announce their changes by version stamp
+    recorders = Recorder.__table__
+    database.session.execute(recorders.delete().where(
+        recorders.c.uid == recorder2.uid))
+    database.session.commit()
+    assert register(keys[1], series_uid).status_code == 200
+    cache.bump_table_version('recorder')
+    assert register(keys[1], series_uid).status_code == 401
+
+
+def test_registering_records_batch(app, client, database, queries):
+    recorder = models.RecorderFactory.create()
+    series1 = models.SeriesFactory.create(recorder=recorder)
+    series2 = models.SeriesFactory.create(recorder=recorder)
+    foreign_series = models.SeriesFactory.create()
+    existing = models.RecordFactory.create(series=series1)
+    batch = [creators.create_record(series_uid=series1.uid)
+             for _ in range(5)]
+    batch += [creators.create_record(series_uid=series2.uid, label='normal'),
+              creators.create_record(series_uid=foreign_series.uid),
+              creators.create_record(series_uid=series1.uid, label='nope'),
+              creators.create_record(uid=existing.uid,
+                                     series_uid=series1.uid)]
+    queries.clear()
+    response = client.post(
+        f"{BASE_URL}/record/batch",
+        data=json.dumps(batch),
+        content_type='application/json',
+        headers={'recorder_key': encode_recorder_key(recorder.uid)}
+    )
+    assert response.status_code == 200
+    inserts = [q for q in queries if q.startswith('INSERT')]
+    assert len(inserts) == 1
+    data = json.loads(response.data)
+    assert [r['status'] for r in data] == [200] * 6 + [403, 404, 409]
+    assert data[5]['record']['stop_time'] == \
+        batch[5]['start_time'] + series2.parameters.duration
+    assert Record.query.filter_by(series_uid=series1.uid).count() == 6
+
+    max_size = app.config['RECORD_BATCH_MAX_SIZE']
+    app.config['RECORD_BATCH_MAX_SIZE'] = 2
+    try:
+        response = client.post(
+            f"{BASE_URL}/record/batch",
+            data=json.dumps(batch),
+            content_type='application/json',
+            headers={'recorder_key': encode_recorder_key(recorder.uid)}
+        )
+        assert response.status_code == 413
+    finally:
+        app.config['RECORD_BATCH_MAX_SIZE'] = max_size
+
+    max_bytes = app.config['RECORD_BATCH_MAX_BYTES']
+    app.config['RECORD_BATCH_MAX_BYTES'] = len(json.dumps(batch)) - 1
+    try:
+        queries.clear()
+        response = client.post(
+            f"{BASE_URL}/record/batch",
+            data=json.dumps(batch),
+            content_type='application/json',
+            headers={'recorder_key': encode_recorder_key(recorder.uid)}
+        )
+        assert response.status_code == 413
+        assert queries == []
+    finally:
+        app.config['RECORD_BATCH_MAX_BYTES'] = max_bytes
+
+
+def test_caching_responses(app, client, database, queries):
+    series = models.SeriesFactory.create()
+    recorder = series.recorder
+    series_uid, recorder_uid = series.uid, recorder.uid
+    models.RecordFactory.create(series=series)
+    url = f"{BASE_URL}/record?series_uid={series_uid}&limit=10"
+    assert len(json.loads(client.get(url).data)) == 1
+    queries.clear()
+    response = client.get(f"{BASE_URL}/record?limit=10&series_uid="
+                          f"{series_uid}")
+    assert queries == []
+    assert len(json.loads(response.data)) == 1
+
+    # records registered in batch are seen at once
+    client.post(
+        f"{BASE_URL}/record/batch",
+        data=json.dumps([creators.create_record(series_uid=series_uid)]),
+        content_type='application/json',
+        headers={'recorder_key': encode_recorder_key(recorder_uid)}
+    )
+    assert len(json.loads(client.get(url).data)) == 2
+
+    url = f"{BASE_URL}/series?recorder_uid={recorder_uid}"
+    assert len(json.loads(client.get(url).data)) == 1
+    models.SeriesFactory.create(recorder=recorder)
+    assert len(json.loads(client.get(url).data)) == 2
+    response = client.get(f"{BASE_URL}/record?series_uid={series_uid}"
+                          "&stream=true")
+    assert len(response.data.splitlines()) == 2
+
+
 @pytest.mark.usefixtures('database')
-def test_deleting_record(app, client):
+def test_getting_metrics(app, client):
+    models.SeriesFactory.create()
+    for _ in range(2):
+        response = client.get(f"{BASE_URL}/series")
+        assert len(json.loads(response.data)) == 1
+    response = client.get(f"{BASE_URL}/metrics")
+    assert response.status_code == 200
+    assert json.loads(response.data)['coalescing'] == {
+        'executed': 2, 'coalesced': 0, 'timed_out': 0
+    }
+
+
+def test_deleting_record(app, client, database):
     record = models.RecordFactory.create()
     record.filepath.touch()
     assert record.filepath.exists()
+    upload_session = UploadSession(record_uid=record.uid)
+    database.session.add(upload_session)
+    database.session.commit()
+    session_file = upload_session.filepath
+    session_file.parent.mkdir(parents=True, exist_ok=True)
+    session_file.write_bytes(b'partial')
     response = client.delete(f"{BASE_URL}/record/{record.uid}")
     assert response.status_code == 204
     assert not record.filepath.exists()
+    assert not session_file.exists()
+    assert Record.query.filter_by(uid=record.uid).count() == 0
+    assert UploadSession.query.count() == 0
+
+
+@pytest.mark.usefixtures('database')
+def test_content_addressed_storage(app, client):
+    storage_setting = app.config['MEDIA_STORAGE']
+    grace_period = app.config['MEDIA_GC_GRACE_PERIOD']
+    app.config['MEDIA_STORAGE'] = 'content-addressed'
+    try:
+        recorder = models.RecorderFactory.create()
+        records = models.RecordFactory.create_batch(
+            2, series=models.SeriesFactory.create(recorder=recorder)
+        )
+        for record in records:
+            response = client.post(
+                f"{BASE_URL}/record/{record.uid}/upload",
+                data={'file': (BytesIO(WAV), 'record.wav')},
+                headers={'recorder_key': encode_recorder_key(recorder.uid)},
+                content_type='multipart/form-data'
+            )
+            assert response.status_code == 200
+        tasks.wait_for_background_jobs()
+        records = [Record.query.filter_by(uid=r.uid).one() for r in records]
+        blob = storage.ContentAddressedStorage().blob_path(
+            hashlib.sha256(WAV).hexdigest()
+        )
+        assert records[0].filepath == records[1].filepath == blob
+        assert blob.with_suffix('.peaks').exists()
+        assert not (app.config['UPLOADS_DEFAULT_DEST'] /
+                    records[0].series_uid / records[0].filename).exists()
+
+        response = client.get(f"{BASE_URL}/record/{records[0].uid}/download")
+        assert response.data == WAV
+
+        app.config['MEDIA_GC_GRACE_PERIOD'] = -1
+        client.delete(f"{BASE_URL}/record/{records[0].uid}")
+        assert remove_unreferenced_blobs() == 0
+        assert records[1].is_uploaded()
+        client.delete(f"{BASE_URL}/record/{records[1].uid}")
+        # blob and its peaks
+        assert remove_unreferenced_blobs() == 2
+        assert not blob.exists()
+    finally:
+        app.config['MEDIA_STORAGE'] = storage_setting
+        app.config['MEDIA_GC_GRACE_PERIOD'] = grace_period
+
+
+@pytest.mark.usefixtures('database')
+def test_flac_storage(app, client, monkeypatch):
+    soundfile = pytest.importorskip('soundfile')
+    recorder = models.RecorderFactory.create()
+    parameters = models.RecordingParametersFactory.create(
+        samplerate=8000, channels=2, duration=0.5
+    )
+    record = models.RecordFactory.create(series=models.SeriesFactory.create(
+        recorder=recorder, parameters=parameters
+    ))
+    headers = {'recorder_key': encode_recorder_key(recorder.uid)}
+    content = creators.create_wav(samplerate=8000, channels=2, duration=0.5)
+    # chunks other than samples are served as uploaded
+    info = b'LIST' + struct.pack('<I', 5) + b'INFO!' + b'\x00'
+    content = content[:36] + info + content[36:] + info
+    app.config['MEDIA_FLAC'] = True
+    try:
+        response = client.post(
+            f"{BASE_URL}/record/{record.uid}/upload",
+            data={'file': (BytesIO(content), 'record.wav')},
+            headers=headers,
+            content_type='multipart/form-data'
+        )
+        assert response.status_code == 200
+        tasks.wait_for_background_jobs()
+    finally:
+        app.config['MEDIA_FLAC'] = False
+    assert record.filepath.suffix == '.flac'
+    assert record.is_uploaded()
+
+    url = f"{BASE_URL}/record/{record.uid}/download"
+    response = client.get(url)
+    assert response.mimetype == 'audio/wav'
+    assert response.headers['Content-Length'] == str(len(content))
+    assert response.data == content
+    assert hashlib.sha256(response.data).hexdigest() == record.checksum
+    response = client.get(url, headers={'Range': 'bytes=40-99'})
+    assert response.status_code == 206
+    assert response.data == content[40:100]
+
+    response = client.get(url, headers={'Accept': 'audio/flac'})
+    assert response.mimetype == 'audio/flac'
+    assert response.data.startswith(b'fLaC')
+    flac, _ = soundfile.read(BytesIO(response.data), dtype='int16')
+    wav, _ = soundfile.read(BytesIO(content), dtype='int16')
+    assert (flac == wav).all()
+
+    # transcoded file is not transcoded again
+    assert tasks.transcode_records(workers=2) == 0
+
+    # file uploaded again while being transcoded is kept
+    content = creators.create_wav(samplerate=8000, channels=2, duration=0.5)
+    response = client.post(
+        f"{BASE_URL}/record/{record.uid}/upload",
+        data={'file': (BytesIO(content), 'record.wav')},
+        headers=headers,
+        content_type='multipart/form-data'
+    )
+    assert record.filepath.suffix == '.wav'
+    encode_flac = audio.encode_flac
+
+    def reupload(source, target):
+        encode_flac(source, target)
+        source.with_suffix('.tmp').write_bytes(content)
+        os.replace(str(source.with_suffix('.tmp')), str(source))
+
+    monkeypatch.setattr(audio, 'encode_flac', reupload)
+    assert not storage.transcode_to_flac(record)
+    assert record.filepath.suffix == '.wav'
+    assert record.filepath.read_bytes() == content
+
+
+def test_relayout_record_files(app, database):
+    layout = app.config['MEDIA_LAYOUT']
+    batch_size = app.config['RECORDS_STREAM_BATCH_SIZE']
+    records = models.RecordFactory.create_batch(3, uploaded_at=datetime.now())
+    for record in records:
+        record.filepath.parent.mkdir(parents=True, exist_ok=True)
+        record.filepath.write_bytes(b'content_of_file')
+    flat_paths = [r.filepath for r in records]
+    try:
+        app.config['MEDIA_LAYOUT'] = 'uid'
+        app.config['RECORDS_STREAM_BATCH_SIZE'] = 1
+        # files are found in previous layout before they are moved
+        assert [r.filepath for r in records] == flat_paths
+        assert all(r.is_uploaded() for r in records)
+
+        # resume after first record was moved by interrupted relayout
+        checkpoint = app.config['UPLOADS_DEFAULT_DEST'] / '.relayout-uid'
+        checkpoint.write_text(str(records[0].id))
+        assert relayout_record_files(workers=2) == 2
+        assert not checkpoint.exists()
+        assert relayout_record_files(workers=2, restart=True) == 1
+        assert relayout_record_files(workers=2) == 0
+        assert not storage.relayout_pending()
+        for record in records:
+            uid = str(record.uid)
+            assert record.filepath == app.config['UPLOADS_DEFAULT_DEST'] / \
+                record.series_uid / uid[:2] / uid[2:4] / (uid + '.wav')
+            assert record.filepath.read_bytes() == b'content_of_file'
+        assert not any(path.exists() for path in flat_paths)
+
+        # file stored meanwhile in layout is not replaced by moved one
+        flat_paths[0].write_bytes(b'previous_content')
+        assert not storage.move_into_layout([records[0].filepath,
+                                             flat_paths[0]])
+        assert records[0].filepath.read_bytes() == b'content_of_file'
+    finally:
+        app.config['MEDIA_LAYOUT'] = layout
+        app.config['RECORDS_STREAM_BATCH_SIZE'] = batch_size
 
 
 @pytest.mark.usefixtures('database')
@@ -203,11 +582,20 @@ def test_uploading_file(app, client):
     record = models.RecordFactory.create(series=series)
     response = client.post(
         f"{BASE_URL}/record/{record.uid}/upload",
-        data={'file': (BytesIO(b'content_of_file'), 'filename.wav')},
+        data={'file': (BytesIO(WAV), 'filename.wav')},
         content_type='multipart/form-data',
         headers={'recorder_key': encode_recorder_key(recorder.uid)}
     )
     assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['checksum'] == hashlib.sha256(WAV).hexdigest()
+    assert data['size'] == len(WAV)
+    assert data['frames'] == 441000
+    assert data['bit_depth'] == 16
+    assert record.filepath.read_bytes() == WAV
+    # peaks computed in background are staged in incoming directory too
+    tasks.wait_for_background_jobs()
+    assert list(storage.incoming_dir().iterdir()) == []
 
 
 @pytest.mark.usefixtures('database')
@@ -222,6 +610,180 @@ def test_uploading_file_with_wrong_extension(app, client):
         headers={'recorder_key': encode_recorder_key(recorder.uid)}
     )
     assert response.status_code == 400
+    assert list(storage.incoming_dir().iterdir()) == []
+
+
+@pytest.mark.parametrize('content, error', [
+    (b'content_of_file', 'not a RIFF WAVE'),
+    (creators.create_wav(samplerate=48000, duration=10.0), 'samplerate'),
+    (creators.create_wav(channels=2, duration=10.0), 'channels'),
+    (creators.create_wav(duration=9.0), 'frames'),
+    (WAV[:len(WAV) // 2], 'truncated'),
+    (WAV[:30], 'truncated'),
+])
+@pytest.mark.usefixtures('database')
+def test_uploading_invalid_wav(app, client, content, error):
+    recorder = models.RecorderFactory.create()
+    series = models.SeriesFactory.create(recorder=recorder)
+    record = models.RecordFactory.create(series=series)
+    response = client.post(
+        f"{BASE_URL}/record/{record.uid}/upload",
+        data={'file': (BytesIO(content), 'filename.wav')},
+        content_type='multipart/form-data',
+        headers={'recorder_key': encode_recorder_key(recorder.uid)}
+    )
+    assert response.status_code == 400
+    assert error in json.loads(response.data)['detail']
+    assert not record.filepath.exists()
+    assert list(storage.incoming_dir().iterdir()) == []
+
+
+@pytest.mark.usefixtures('database')
+def test_ingesting_record(app, client, queries):
+    recorder = models.RecorderFactory.create()
+    series = models.SeriesFactory.create(recorder=recorder)
+    record_data = creators.create_record(series_uid=series.uid)
+    record_data.pop('label_uid')
+
+    def ingest(content):
+        return client.post(
+            f"{BASE_URL}/record/ingest",
+            data=dict(record_data, file=(BytesIO(content), 'record.wav')),
+            content_type='multipart/form-data',
+            headers={'recorder_key': encode_recorder_key(recorder.uid)}
+        )
+
+    response = ingest(WAV)
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['uid'] == record_data['uid']
+    assert data['uploaded_at'] is not None
+    record = Record.query.filter_by(uid=record_data['uid']).one()
+    assert record.filepath.read_bytes() == WAV
+    mtime = record.filepath.stat().st_mtime_ns
+
+    # retry does not duplicate record nor rewrite file
+    queries.clear()
+    response = ingest(WAV)
+    assert response.status_code == 200
+    assert json.loads(response.data)['uploaded_at'] == data['uploaded_at']
+    assert not [q for q in queries if q.startswith(('INSERT', 'UPDATE'))]
+    assert record.filepath.stat().st_mtime_ns == mtime
+    assert Record.query.filter_by(uid=record_data['uid']).count() == 1
+
+    response = ingest(creators.create_wav(duration=10.0))
+    assert response.status_code == 409
+
+
+def test_ingesting_record_concurrently(app, client, database, monkeypatch):
+    recorder = models.RecorderFactory.create()
+    series = models.SeriesFactory.create(recorder=recorder)
+    headers = {'recorder_key': encode_recorder_key(recorder.uid)}
+    check_uploaded_wav = labapp_api.check_uploaded_wav
+
+    def ingest(content, winner_content):
+        record_data = creators.create_record(series_uid=series.uid)
+        record_data.pop('label_uid')
+
+        # other ingest of the same record commits while this one checks file
+        def check_racing(record, digest, parameters):
+            with database.engine.begin() as connection:
+                connection.execute(Record.__table__.insert(), {
+                    'uid': record.uid, 'series_uid': series.uid,
+                    'start_time': record_data['start_time'],
+                    'uploaded_at': datetime.now(),
+                    'checksum': hashlib.sha256(winner_content).hexdigest(),
+                    'size': len(winner_content)
+                })
+            check_uploaded_wav(record, digest, parameters)
+
+        monkeypatch.setattr(labapp_api, 'check_uploaded_wav', check_racing)
+        response = client.post(
+            f"{BASE_URL}/record/ingest",
+            data=dict(record_data, file=(BytesIO(content), 'record.wav')),
+            content_type='multipart/form-data', headers=headers
+        )
+        record = Record.query.filter_by(uid=record_data['uid']).one()
+        # file of winning ingest is not overwritten
+        assert not record.filepath.exists()
+        return response
+
+    response = ingest(WAV, WAV)
+    assert response.status_code == 200, response.data
+    assert ingest(WAV, creators.create_wav(duration=10.0)).status_code == 409
+
+
+@pytest.mark.usefixtures('database')
+def test_resumable_upload(app, client):
+    recorder = models.RecorderFactory.create()
+    series = models.SeriesFactory.create(recorder=recorder)
+    record = models.RecordFactory.create(series=series)
+    content = WAV
+    headers = {'recorder_key': encode_recorder_key(recorder.uid)}
+    url = f"{BASE_URL}/record/{record.uid}/uploads"
+    response = client.post(url, data=json.dumps({'length': len(content)}),
+                           content_type='application/json', headers=headers)
+    assert response.status_code == 201
+    session_url = url + '/' + json.loads(response.data)['uid']
+
+    def patch(offset, chunk):
+        return client.patch(
+            session_url, data=chunk,
+            content_type='application/offset+octet-stream',
+            headers=dict(headers, **{'Upload-Offset': str(offset)})
+        )
+
+    # oversized chunk is refused by its declared length, before it is read
+    class Unread(BytesIO):
+        def read(self, *args):
+            raise AssertionError("Chunk was read")
+
+    for length, status in [(app.config['UPLOAD_CHUNK_MAX_SIZE'] + 1, 413),
+                           ('', 411)]:
+        response = client.patch(
+            session_url, input_stream=Unread(),
+            environ_overrides={'CONTENT_LENGTH': str(length)},
+            content_type='application/offset+octet-stream',
+            headers=dict(headers, **{'Upload-Offset': '0'})
+        )
+        assert response.status_code == status
+    assert patch(0, content[:10]).status_code == 204
+    # connection lost, continue from offset reported by server
+    response = client.head(session_url, headers=headers)
+    assert response.status_code == 200
+    assert response.headers['Upload-Offset'] == '10'
+    assert response.headers['Upload-Length'] == str(len(content))
+    assert patch(5, content[5:]).status_code == 409
+    response = client.post(session_url + '/finalize', headers=headers)
+    assert response.status_code == 409
+    response = patch(10, content[10:])
+    assert response.status_code == 204
+    assert response.headers['Upload-Offset'] == str(len(content))
+    response = client.post(session_url + '/finalize', headers=headers)
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['checksum'] == hashlib.sha256(content).hexdigest()
+    assert data['uploaded_at'] is not None
+    assert record.filepath.read_bytes() == content
+    assert client.head(session_url, headers=headers).status_code == 404
+
+
+@pytest.mark.usefixtures('database')
+def test_removing_expired_upload_sessions(app, database):
+    record = models.RecordFactory.create()
+    upload_session = UploadSession(record_uid=record.uid)
+    database.session.add(upload_session)
+    database.session.commit()
+    upload_session.filepath.parent.mkdir(parents=True, exist_ok=True)
+    upload_session.filepath.write_bytes(b'partial')
+    assert remove_expired_upload_sessions() == 0
+    upload_session.updated_at = datetime.now() - timedelta(
+        seconds=app.config['UPLOAD_SESSION_TTL'] + 1)
+    database.session.commit()
+    filepath = upload_session.filepath
+    assert remove_expired_upload_sessions() == 1
+    assert not filepath.exists()
+    assert UploadSession.query.count() == 0
 
 
 @pytest.mark.usefixtures('database')
@@ -239,6 +801,306 @@ def test_downloading_files(app, client):
     assert response.data == b"content_of_file"
 
 
+@pytest.mark.usefixtures('database')
+def test_downloading_file_ranges(app, client):
+    record = models.RecordFactory.create(uploaded_at=datetime.now())
+    record.filepath.parent.mkdir(parents=True, exist_ok=True)
+    record.filepath.write_bytes(b"content_of_file")
+    url = f"{BASE_URL}/record/{record.uid}/download"
+    response = client.get(url)
+    etag = response.headers['ETag']
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+    response = client.get(url, headers={'Range': 'bytes=8-11'})
+    assert response.status_code == 206
+    assert response.data == b"of_f"
+    assert response.headers['Content-Range'] == 'bytes 8-11/15'
+
+    response = client.get(url, headers={'Range': 'bytes=8-', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == b"of_file"
+
+    response = client.get(url, headers={'Range': 'bytes=8-',
+                                        'If-Range': '"other"'})
+    assert response.status_code == 200
+    assert response.data == b"content_of_file"
+
+    response = client.get(url, headers={'Range': 'bytes=20-'})
+    assert response.status_code == 416
+
+    # ranges are handed to gunicorn's file wrapper seeked to range start,
+    # which sends no more than Content-Length
+    class FileWrapper:
+        def __init__(self, file, buffer_size=8192):
+            self.file = file
+
+        def __iter__(self):
+            return iter([self.file.read()])
+
+        def close(self):
+            self.file.close()
+
+    environ = {'wsgi.file_wrapper': FileWrapper}
+    response = client.get(url, headers={'Range': 'bytes=8-11'},
+                          environ_overrides=environ)
+    assert response.status_code == 206
+    assert response.data == b"of_f"
+    environ['SERVER_SOFTWARE'] = 'gunicorn/20.1.0'
+    with app.test_request_context(headers={'Range': 'bytes=8-11'},
+                                  environ_overrides=environ):
+        response = storage.send_file(record.filepath, record.filename)
+    assert response.status_code == 206
+    assert response.headers['Content-Length'] == '4'
+    assert isinstance(response.response, FileWrapper)
+    assert response.response.file.tell() == 8
+    assert response.response.file.read(4) == b"of_f"
+    response.close()
+
+
+@pytest.mark.usefixtures('database')
+def test_downloading_files_offloaded(app, client):
+    record = models.RecordFactory.create(uploaded_at=datetime.now())
+    record.filepath.parent.mkdir(parents=True, exist_ok=True)
+    record.filepath.write_bytes(b"content_of_file")
+    url = f"{BASE_URL}/record/{record.uid}/download"
+    offload = app.config['DOWNLOAD_OFFLOAD']
+    try:
+        app.config['DOWNLOAD_OFFLOAD'] = 'x-accel-redirect'
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.data == b""
+        assert response.headers['X-Accel-Redirect'] == \
+            f"/protected-media/{record.series_uid}/{record.uid}.wav"
+
+        app.config['DOWNLOAD_OFFLOAD'] = 'x-sendfile'
+        response = client.get(url)
+        assert response.headers['X-Sendfile'] == str(record.filepath)
+    finally:
+        app.config['DOWNLOAD_OFFLOAD'] = offload
+
+
+@pytest.mark.parametrize('format', ['zip', 'tar'])
+@pytest.mark.usefixtures('database')
+def test_downloading_records_archive(app, client, format):
+    series = models.SeriesFactory.create()
+    records = models.RecordFactory.create_batch(
+        3, series=series, uploaded_at=datetime.now()
+    )
+    records[0].filepath.parent.mkdir(parents=True, exist_ok=True)
+    for record in records[:2]:
+        record.filepath.write_bytes(str(record.uid).encode() * 100)
+    models.RecordFactory.create(uploaded_at=datetime.now())
+    response = client.get(f"{BASE_URL}/record/archive", query_string={
+        'series_uid': series.uid, 'format': format
+    })
+    assert response.status_code == 200
+    assert response.is_streamed
+    data = BytesIO(response.data)
+    if format == 'zip':
+        archive = zipfile.ZipFile(data)
+        assert archive.testzip() is None
+        files = {n: archive.read(n) for n in archive.namelist()}
+    else:
+        archive = tarfile.open(fileobj=data)
+        files = {m.name: archive.extractfile(m).read() for m in archive}
+    manifest = json.loads(files.pop('manifest.json'))
+    assert sorted(r['uid'] for r in manifest) == \
+        sorted(r.uid for r in records[:2])
+    for entry in manifest:
+        assert files[entry['file']] == entry['uid'].encode() * 100
+    assert len(files) == 2
+
+
+def test_exporting_records_dataset(app, client, database):
+    series = models.SeriesFactory.create(
+        parameters=models.RecordingParametersFactory.create(
+            samplerate=8000, channels=2, duration=0.5
+        )
+    )
+    records = models.RecordFactory.create_batch(
+        3, series=series, uploaded_at=datetime.now()
+    )
+    contents = [creators.create_wav(8000, 2, duration)
+                for duration in (0.5, 0.5, 0.4999)]
+    records[0].filepath.parent.mkdir(parents=True, exist_ok=True)
+    for record, content in zip(records[:2], contents):
+        record.filepath.write_bytes(content)
+    models.RecordFactory.create(series=series)
+    url = f"{BASE_URL}/record/export"
+    query = {'series_uid': series.uid}
+
+    def export(query):
+        response = client.post(url, query_string=query)
+        assert response.status_code == 202
+        key = json.loads(response.data)['key']
+        assert response.headers['Location'].endswith(f"{url}/{key}")
+        tasks.wait_for_background_jobs()
+        return client.get(f"{url}/{key}")
+
+    index = json.loads(export(query).data)
+    assert index['shape'] == [2, 4000, 2]
+    assert index['dtype'] == '<i2'
+    data = client.get(f"{url}/{index['key']}/data").data
+    rows = np.frombuffer(data, index['dtype']).reshape(index['shape'])
+    for entry, row in zip(index['records'], rows):
+        content = contents[[r.uid for r in records].index(entry['uid'])]
+        assert row.tobytes() == content[44:]
+
+    # only new records are appended
+    path = dataset.data_path(index['key'])
+    inode = path.stat().st_ino
+    records[2].filepath.write_bytes(contents[2])
+    index = json.loads(export(query).data)
+    assert index['shape'] == [3, 4000, 2]
+    assert index['records'][2]['uid'] == records[2].uid
+    data = client.get(f"{url}/{index['key']}/data").data
+    assert len(data) == 3 * 4000 * 2 * 2
+    assert data[:2 * 16000] == rows.tobytes()
+    # short file is padded with silence
+    assert data[2 * 16000:] == contents[2][44:] + bytes(2 * 2)
+    assert json.loads(client.get(f"{url}/{index['key']}").data) == index
+    assert path.stat().st_ino == inode
+
+    # relabelled record leaves export of its former label in new file
+    label = models.LabelFactory.create()
+    query = {'series_uid': series.uid, 'label': label.uid}
+    for record in records[:2]:
+        record.label = label
+    database.session.commit()
+    index = json.loads(export(query).data)
+    assert index['shape'] == [2, 4000, 2]
+    inode = dataset.data_path(index['key']).stat().st_ino
+    records[0].label = None
+    database.session.commit()
+    index = json.loads(export(query).data)
+    assert [entry['uid'] for entry in index['records']] == [records[1].uid]
+    path = dataset.data_path(index['key'])
+    assert path.stat().st_ino != inode
+    assert path.read_bytes() == contents[1][44:]
+
+    other = models.RecordFactory.create(uploaded_at=datetime.now())
+    other.filepath.parent.mkdir(parents=True, exist_ok=True)
+    other.filepath.write_bytes(creators.create_wav(duration=10.0))
+    response = export({'series_uid': [series.uid, other.series_uid]})
+    assert response.status_code == 409
+    assert client.post(url, query_string={
+        'recorded_from': '2020-01-02', 'recorded_to': '2020-01-01'
+    }).status_code == 400
+    assert client.get(f"{url}/0000").status_code == 404
+
+
+@pytest.mark.usefixtures('database')
+def test_getting_record_peaks(app, client, monkeypatch):
+    recorder = models.RecorderFactory.create()
+    record = models.RecordFactory.create(
+        series=models.SeriesFactory.create(recorder=recorder)
+    )
+    url = f"{BASE_URL}/record/{record.uid}/peaks"
+    assert client.get(url).status_code == 404
+    client.post(
+        f"{BASE_URL}/record/{record.uid}/upload",
+        data={'file': (BytesIO(WAV), 'record.wav')},
+        headers={'recorder_key': encode_recorder_key(recorder.uid)},
+        content_type='multipart/form-data'
+    )
+    tasks.wait_for_background_jobs()
+    peaks_path = record.filepath.with_suffix('.peaks')
+    assert peaks_path.stat().st_size < len(WAV) / 50
+
+    response = client.get(url, query_string={'width': 500})
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert len(data['min']) == len(data['max']) == 500
+    assert data['frames'] == 441000
+    # 1723 finest peaks of 256 frames merged into 500
+    assert data['samples_per_peak'] == 256 * 1723 / 500
+    samples = memoryview(WAV[44:]).cast('h')
+    assert data['min'][0] == min(samples[:3 * 256])
+    assert data['max'][0] == max(samples[:3 * 256])
+    assert all(lo <= hi for lo, hi in zip(data['min'], data['max']))
+
+    # finest level is returned when more peaks are requested than stored
+    data = json.loads(client.get(url, query_string={'width': 5000}).data)
+    assert data['samples_per_peak'] == 256
+    assert len(data['min']) == 1723
+
+    # peaks lost are computed again on request
+    peaks_path.unlink()
+    assert client.get(url).status_code == 200
+    assert peaks_path.exists()
+
+    # peaks of file replaced while computing them are discarded
+    peaks_path.unlink()
+    compute_peaks = audio.compute_peaks
+
+    def reupload(path):
+        result = compute_peaks(path)
+        path.with_suffix('.tmp').write_bytes(WAV)
+        os.replace(str(path.with_suffix('.tmp')), str(path))
+        return result
+
+    monkeypatch.setattr(audio, 'compute_peaks', reupload)
+    assert client.get(url).status_code == 409
+    assert not peaks_path.exists()
+    monkeypatch.undo()
+
+    # files stored before headers were checked have no peaks
+    record.filepath.write_bytes(b'RIFF' + WAV[4:36])
+    assert client.get(url).status_code == 404
+
+
+@pytest.mark.usefixtures('database')
+def test_getting_record_features(app, client):
+    recorder = models.RecorderFactory.create()
+    record = models.RecordFactory.create(
+        series=models.SeriesFactory.create(recorder=recorder)
+    )
+    url = f"{BASE_URL}/record/{record.uid}/features"
+    assert client.get(url).status_code == 404
+    upload = dict(
+        path=f"{BASE_URL}/record/{record.uid}/upload",
+        headers={'recorder_key': encode_recorder_key(recorder.uid)},
+        content_type='multipart/form-data'
+    )
+    client.post(data={'file': (BytesIO(WAV), 'record.wav')}, **upload)
+
+    # computed on first request
+    response = client.get(url)
+    assert response.status_code == 200
+    features = np.load(BytesIO(response.data))
+    assert features.dtype == np.float32
+    assert features.shape == (1 + (441000 - 1024) // 512, 64)
+    config = storage.features_config()
+    path = storage.features_path(record, config)
+    assert np.array_equal(np.load(str(path), mmap_mode='r'), features)
+    shape, batches = audio.compute_features(record.filepath, **config)
+    assert shape == features.shape
+    assert np.array_equal(np.concatenate(list(batches)), features)
+
+    assert client.get(url, query_string={'n_fft': 8}).status_code == 400
+    assert client.get(url, query_string={'hop_length': 255}).status_code == \
+        400
+    # other configurations are computed ahead of requests only
+    stft = {'kind': 'stft', 'n_mels': 8}
+    assert client.get(url, query_string=stft).status_code == 404
+    config = storage.features_config(kind='stft')
+    assert tasks.compute_series_features(record.series_uid, 2, config) == 1
+    assert tasks.compute_series_features(record.series_uid, 2, config) == 0
+    response = client.get(url, query_string=stft)
+    assert np.load(BytesIO(response.data)).shape == (860, 513)
+
+    # files stored before headers were checked have no features
+    path.unlink()
+    valid = record.filepath.read_bytes()
+    record.filepath.write_bytes(valid[:36])
+    assert client.get(url).status_code == 404
+    record.filepath.write_bytes(valid)
+
+    # features of previous file are removed with it
+    client.post(data={'file': (BytesIO(WAV), 'record.wav')}, **upload)
+    assert storage.features_paths(record) == []
+
+
 @pytest.mark.usefixtures('database')
 def test_getting_record_parameters(app, client):
     parameters = models.RecordingParametersFactory.create()
@@ -280,6 +1142,28 @@ def test_getting_recorders(app, client, database, attributes, data_len):
     assert len(data) == data_len
 
 
+@pytest.mark.usefixtures('database')
+def test_getting_recorders_by_series(app, client, queries):
+    series1 = models.SeriesFactory.create()
+    series2 = models.SeriesFactory.create(recorder=series1.recorder)
+    series3 = models.SeriesFactory.create()
+    models.RecorderFactory.create()
+    response = client.get(f"{BASE_URL}/recorder?series_uid={series1.uid}")
+    data = json.loads(response.data)
+    assert [r['uid'] for r in data] == [series1.recorder.uid]
+    response = client.get(f"{BASE_URL}/recorder?series_uid={series1.uid}" +
+                          f"&series_uid={series3.uid}")
+    assert len(json.loads(response.data)) == 2
+
+    queries.clear()
+    response = client.get(f"{BASE_URL}/recorder?with_series=true")
+    assert len(queries) == 1
+    data = {r['uid']: r['series_uids'] for r in json.loads(response.data)}
+    assert len(data) == 3
+    assert data[series1.recorder.uid] == [series1.uid, series2.uid]
+    assert data[series3.recorder.uid] == [series3.uid]
+
+
 @pytest.mark.usefixtures('database')
 def test_adding_recorder(app, client):
     new_recorder = creators.create_recorder()
@@ -359,7 +1243,9 @@ def test_setting_recorders_current_series(app, client):
     ({'duration': '1'}, 2),
     ({'samplerate': '10000'}, 2),
     ({'channels': '1'}, 4),
-    ({'amplification': '1'}, 2)
+    ({'amplification': '1'}, 2),
+    ({'recorder_uid': 'Recorder2', 'samplerate': '22050'}, 1),
+    ({'parameters_uid': 'ParametersSet2', 'channels': '1'}, 2)
 ])
 @pytest.mark.usefixtures('database')
 def test_getting_serieses(app, client, database, attributes, data_len):
@@ -501,6 +1387,69 @@ def test_get_series(app, client):
         series.parameters.amplification
 
 
+@pytest.mark.usefixtures('database')
+def test_getting_series_audio(app, client):
+    series = models.SeriesFactory.create(
+        parameters=models.RecordingParametersFactory.create(
+            samplerate=8000, channels=1, duration=1.0
+        )
+    )
+    start = datetime(2020, 1, 1, 12)
+    records = [
+        models.RecordFactory.create(
+            series=series, uploaded_at=datetime.now(),
+            start_time=datetime_to_time(start) + offset
+        )
+        for offset in (0, 1, 2, 3)
+    ]
+    models.RecordFactory.create(start_time=datetime_to_time(start))
+    contents = [creators.create_wav(8000, 1, 1.0) for _ in records]
+    records[0].filepath.parent.mkdir(parents=True, exist_ok=True)
+    # file of third record is missing
+    for record, content in zip(records[:2] + records[3:],
+                               contents[:2] + contents[3:]):
+        record.filepath.write_bytes(content)
+
+    response = client.get(f"{BASE_URL}/series/{series.uid}/audio",
+                          query_string={
+                              'from': (start + timedelta(seconds=0.5)).
+                              isoformat(),
+                              'to': (start + timedelta(seconds=3.5)).
+                              isoformat()
+                          })
+    assert response.status_code == 200
+    assert response.is_streamed
+    data = response.data
+    assert len(data) == response.content_length == 44 + 3 * 8000 * 2
+    assert data[:44] == creators.create_wav(8000, 1, 3.0)[:44]
+    assert data[44:] == contents[0][44 + 8000:] + contents[1][44:] + \
+        bytes(8000 * 2) + contents[3][44:44 + 8000]
+
+    # file moved while audio is streamed is located once it is read
+    window = {'from': start.isoformat(),
+              'to': (start + timedelta(seconds=4)).isoformat()}
+    response = client.get(f"{BASE_URL}/series/{series.uid}/audio",
+                          query_string=window, buffered=False)
+    chunks = iter(response.response)
+    data = next(chunks)
+    moved = storage.FileSystemStorage().layout_path(records[3], 'uid')
+    moved.parent.mkdir(parents=True, exist_ok=True)
+    records[3].filepath.rename(moved)
+    data += b''.join(chunks)
+    response.close()
+    assert data[44 + 3 * 8000 * 2:] == contents[3][44:]
+
+    response = client.get(f"{BASE_URL}/series/{series.uid}/audio",
+                          query_string={'from': start.isoformat(),
+                                        'to': start.isoformat()})
+    assert response.status_code == 400
+
+    series = models.SeriesFactory.create(parameters=None)
+    response = client.get(f"{BASE_URL}/series/{series.uid}/audio",
+                          query_string=window)
+    assert response.status_code == 404
+
+
 @pytest.mark.usefixtures('database')
 def test_updating_clean_series(app, client, database):
     series = models.SeriesFactory.create()
@@ -541,6 +1490,8 @@ def test_deleting_clean_series(app, client, database):
         f"{BASE_URL}/series/{series.uid}",
     )
     assert response.status_code == 204
+    response = client.get(f"{BASE_URL}/series/{series.uid}")
+    assert response.status_code == 404
 
 
 @pytest.mark.usefixtures('database')
@@ -595,6 +1546,48 @@ def test_updating_series_parameters_with_new_parameters(app, client):
     assert data['amplification'] == new_parameters['amplification']
 
 
+@pytest.mark.usefixtures('database')
+def test_updating_series_parameters_updates_records_stop_time(app, client):
+    series = models.SeriesFactory.create()
+    record = models.RecordFactory.create(series=series, start_time=1000.0)
+    assert record.stop_time == 1000.0 + series.parameters.duration
+    new_parameters = creators.create_recording_parameters(duration=2.5)
+    response = client.put(
+        f"{BASE_URL}/series/{series.uid}/parameters",
+        data=json.dumps(new_parameters),
+        content_type='application/json'
+    )
+    assert response.status_code == 200
+    response = client.get(f"{BASE_URL}/record/{record.uid}")
+    data = json.loads(response.data)
+    assert data['duration'] == 2.5
+    assert data['stop_time'] == 1002.5
+    response = client.get(f"{BASE_URL}/record?recorded_to=" +
+                          datetime_to_string(datetime.fromtimestamp(1003)))
+    assert len(json.loads(response.data)) == 1
+
+
+@pytest.mark.usefixtures('database')
+def test_updating_cached_series_parameters_updates_records_duration(app,
+                                                                    client):
+    series = models.SeriesFactory.create()
+    record = models.RecordFactory.create(series=series, start_time=1000.0)
+    # parameters cached by worker must not be used while flushing update
+    client.get(f"{BASE_URL}/series/{series.uid}/parameters")
+    new_parameters = creators.create_recording_parameters(duration=2.5)
+    response = client.put(
+        f"{BASE_URL}/series/{series.uid}/parameters",
+        data=json.dumps(new_parameters),
+        content_type='application/json'
+    )
+    assert response.status_code == 200
+    data = json.loads(client.get(f"{BASE_URL}/record/{record.uid}").data)
+    assert data['duration'] == 2.5
+    assert data['stop_time'] == 1002.5
+    response = client.get(f"{BASE_URL}/series/{series.uid}/parameters")
+    assert json.loads(response.data)['duration'] == 2.5
+
+
 @pytest.mark.usefixtures('database')
 def test_updating_series_parameters_with_uid_of_existing(app, client):
     series = models.SeriesFactory.create()
@@ -641,3 +1634,33 @@ def test_upd_series_parameters_with_dict_containing_existing_uid(app, client):
     data = json.loads(response.data)
     assert data['uid'] == existing_parameters.uid
     assert data['samplerate'] == existing_parameters.samplerate
+
+
+@pytest.mark.parametrize('url', [
+    'record', 'record?stream=true', 'series', 'recorder',
+    'recorder/Recorder0/current_series'
+])
+def test_listing_query_count_does_not_grow(app, client, database, queries,
+                                           url):
+    recorder = models.RecorderFactory.create(uid='Recorder0')
+
+    def populate(n):
+        for _ in range(n):
+            series = models.SeriesFactory.create(
+                recorder=recorder,
+                parameters=models.RecordingParametersFactory.create()
+            )
+            models.RecordFactory.create(series=series)
+        recorder.current_series_uid = series.uid
+        database.session.commit()
+
+    def count_queries():
+        queries.clear()
+        response = client.get(f"{BASE_URL}/{url}")
+        assert response.status_code == 200
+        return len(queries)
+
+    populate(1)
+    small = count_queries()
+    populate(10)
+    assert count_queries() == small
@@ -0,0 +1,57 @@
+import struct
+
+import pytest
+
+from app.audio import parse_wav_header, WavHeaderParser
+from app.tests.fact import creators
+
+
+def feed(content, chunk_size):
+    parser = WavHeaderParser()
+    for offset in range(0, len(content), chunk_size):
+        parser.feed(content[offset:offset + chunk_size])
+    return parser
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 44, 65536])
+def test_parsing_wav_header_in_chunks(chunk_size):
+    content = creators.create_wav(samplerate=16000, channels=2, duration=0.1,
+                                  sampwidth=3)
+    header = feed(content, chunk_size).result()
+    assert header.samplerate == 16000
+    assert header.channels == 2
+    assert header.bits_per_sample == 24
+    assert header.data_offset == 44
+    assert header.frames == 1600
+
+
+def test_parsing_wav_header_skips_other_chunks():
+    content = creators.create_wav(duration=0.01)
+    info = b'LIST' + struct.pack('<I', 5) + b'INFO!' + b'\x00'
+    content = content[:36] + info + content[36:]
+    header = parse_wav_header(content)
+    assert header.data_offset == 44 + len(info)
+    assert header.frames == 441
+
+
+def test_parsing_invalid_wav_header():
+    content = creators.create_wav(duration=0.01)
+    assert parse_wav_header(content[:40]) is None
+    with pytest.raises(ValueError):
+        parse_wav_header(b'RIFX' + content[4:])
+    with pytest.raises(ValueError):
+        parse_wav_header(content[:12] + content[36:])
+    parser = feed(content[:40], 10)
+    with pytest.raises(ValueError, match='truncated'):
+        parser.result()
+
+
+@pytest.mark.parametrize('format_tag,bits,block_align', [
+    (1, 0, 0), (1, 12, 2), (3, 16, 2), (1, 16, 0)
+])
+def test_parsing_wav_header_of_unsupported_samples(format_tag, bits,
+                                                   block_align):
+    content = creators.create_wav(duration=0.01)
+    fmt = struct.pack('<HHIIHH', format_tag, 1, 44100, 0, block_align, bits)
+    with pytest.raises(ValueError):
+        parse_wav_header(content[:20] + fmt + content[36:])
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from app.cache import ResponseCache, SingleFlight, TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expires_entries():
+    clock = Clock()
+    cache = TTLCache(10, 5, timer=clock)
+    cache.set('a', 1)
+    clock.now = 4
+    assert cache.get('a') == 1
+    cache.set('b', 2)
+    clock.now = 5
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    cache.pop('b')
+    assert cache.get('b', 'missing') == 'missing'
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    cache = ResponseCache(tmp_path / 'responses.sqlite', 10)
+    cache.set('a', b'1234')
+    clock.now = 1
+    cache.set('b', b'1234')
+    clock.now = 10
+    assert cache.get('a') == b'1234'
+    clock.now = 11
+    cache.set('c', b'1234')
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (b'1234', b'1234')
+    cache.set('d', b'12345678901')
+    assert cache.get('d') is None
+
+    # recently used entry is not marked as used again
+    clock.now = 13
+    assert cache.get('a') == b'1234'
+    cache.set('e', b'1234')
+    assert cache.get('a') is None
+    # entry is returned even if it can not be marked as used
+    other = ResponseCache(tmp_path / 'responses.sqlite', 10)
+    other.connect().execute('BEGIN IMMEDIATE')
+    clock.now = 100
+    assert cache.get('c') == b'1234'
+    other.close()
+    cache.close()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_single_flight_shares_result_of_call_in_flight():
+    flights = SingleFlight(timeout=5)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def query():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    leader = threading.Thread(target=flights.do, args=('key', query))
+    leader.start()
+    started.wait(5)
+    results = []
+    followers = [threading.Thread(
+        target=lambda: results.append(flights.do('key', query))
+    ) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    wait_until(lambda: flights.flights['key'].waiters == 3)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert results == ['result'] * 3
+    assert len(calls) == 1
+    assert flights.stats == {'executed': 1, 'coalesced': 3, 'timed_out': 0}
+    assert flights.flights == {}
+
+
+def test_single_flight_stops_waiting_after_timeout():
+    flights = SingleFlight(timeout=0.01)
+    started, release = threading.Event(), threading.Event()
+
+    def query():
+        started.set()
+        return release.wait(5)
+
+    leader = threading.Thread(target=flights.do, args=('key', query))
+    leader.start()
+    assert started.wait(5)
+    assert flights.do('key', lambda: 'own') == 'own'
+    release.set()
+    leader.join()
+    assert flights.stats == {'executed': 2, 'coalesced': 0, 'timed_out': 1}
@@ -2,8 +2,8 @@ import pytest
 from datetime import datetime
 
 from app.helpers import (
-    datetime_to_time, encode_recorder_key, increase_last_digit,
-    time_to_datetime, parse_filtering_dates
+    datetime_to_time, decode_cursor, encode_cursor, encode_recorder_key,
+    increase_last_digit, time_to_datetime, parse_filtering_dates
 )
 
 
@@ -48,3 +48,16 @@ def test_datetime_timestamp_conversions():
     t = datetime_to_time(dnow)
     dt = time_to_datetime(t)
     assert dt == dnow
+
+
+def test_encoding_and_decoding_cursor():
+    cursor = encode_cursor(1542279610.1234567, 17)
+    assert isinstance(cursor, str)
+    start_time, id = decode_cursor(cursor)
+    assert float(start_time) == 1542279610.1234567
+    assert id == 17
+    # times stored with more digits than seven decimals are not rounded
+    start_time, _ = decode_cursor(encode_cursor(1.00000001, 17))
+    assert float(start_time) == 1.00000001
+    with pytest.raises(ValueError):
+        decode_cursor('definitely not a cursor')
@@ -4,7 +4,9 @@ from time import time
 import pytest
 from sqlalchemy.orm import exc
 
-from app.models import Label, Record, Recorder, RecordingParameters, Series
+from app.models import (
+    Label, Record, Recorder, RecordingParameters, Series, series_parameters
+)
 from app.tests.fact import models
 
 
@@ -145,3 +147,25 @@ def test_record(database):
     record.uploaded_at = None
     database.session.commit()
     assert not record.is_uploaded()
+
+
+def test_record_duration_of_cached_parameters(database, queries):
+    series = models.SeriesFactory.create()
+    series_uid = series.uid
+    duration = series_parameters(series_uid).duration
+    queries.clear()
+    record = Record(start_time=1000.0, series_uid=series_uid)
+    database.session.add(record)
+    database.session.commit()
+    assert not any('recording_parameters' in statement
+                   for statement in queries)
+    assert record.duration == duration
+
+    # parameters changed in the same transaction are not cached yet
+    parameters = models.RecordingParametersFactory.create(duration=2.5)
+    series.parameters_uid = parameters.uid
+    database.session.flush()
+    record = Record(start_time=1000.0, series_uid=series.uid)
+    database.session.add(record)
+    database.session.commit()
+    assert record.stop_time == 1002.5
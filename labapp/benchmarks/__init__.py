@@ -0,0 +1,80 @@
+"""Helpers shared by labapp benchmarks.
+
+Benchmarks seed their own data into the database given by DATABASE_URL
+(config is taken from FLASK_CONFIG, DevelopmentConfig by default), so
+never point them at a database holding real recordings.
+"""
+import os
+import random
+import statistics
+import time
+
+from app import create_app
+from app.models import db, Record
+
+
+def create_benchmark_app():
+    app = create_app(
+        os.getenv('FLASK_CONFIG', 'app.config.DevelopmentConfig')
+    )
+    app.app_context().push()
+    return app
+
+
+def reset_database():
+    db.session.close()
+    db.drop_all()
+    db.create_all()
+
+
+def measure(func, repeat=5):
+    """Calls func repeat times and returns median duration in
+    milliseconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def explain(query):
+    """Returns rows of database query plan of given ORM query."""
+    statement = query.statement.compile(
+        dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}
+    )
+    prefix = 'EXPLAIN QUERY PLAN' \
+        if db.engine.dialect.name == 'sqlite' else 'EXPLAIN'
+    return db.session.execute('{} {}'.format(prefix, statement)).fetchall()
+
+
+def seed_records(series_count, records_per_series, start_time=1.5e9,
+                 batch_size=5000):
+    """Creates series with test factories and bulk inserts back to back
+    records for each of them. Returns list of created series.
+    """
+    from app.tests.fact import creators, models
+
+    serieses = [models.SeriesFactory.create() for _ in range(series_count)]
+    records = Record.__table__
+    for series in serieses:
+        duration = series.parameters.duration
+        rows = []
+        for n in range(records_per_series):
+            row = creators.create_record(
+                series_uid=series.uid,
+                start_time=start_time + n * duration,
+                label=random.choice(['normal', 'anomaly', None])
+            )
+            row['duration'] = duration
+            row['stop_time'] = row['start_time'] + duration
+            row['uploaded_at'] = None if n % 10 == 0 else series.created_at
+            rows.append(row)
+            if len(rows) == batch_size:
+                db.session.execute(records.insert(), rows)
+                rows = []
+        if rows:
+            db.session.execute(records.insert(), rows)
+        db.session.commit()
+    return serieses
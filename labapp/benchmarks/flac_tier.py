@@ -0,0 +1,97 @@
+"""Measures FLAC storage tier on synthetic clips resembling lab recordings:
+bytes on disk compared to WAV, encode throughput and latency of streamed
+WAV decoding (first block and whole file).
+
+Usage (from labapp directory):
+
+    python -m benchmarks.flac_tier --duration 5 --samplerate 44100
+
+Clips are written to a temporary directory, database is not used.
+"""
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import soundfile
+
+from app.audio import decode_flac, encode_flac
+
+from benchmarks import measure
+
+
+def hum(frames, samplerate, channels, rng):
+    t = np.arange(frames)[:, None] / samplerate
+    signal = sum(0.2 / n * np.sin(2 * np.pi * 50 * n * t) for n in (1, 2, 3))
+    return signal + 0.01 * rng.standard_normal((frames, channels))
+
+
+def speech_like(frames, samplerate, channels, rng):
+    envelope = np.repeat(rng.random(frames // 2000 + 1) ** 3, 2000)[:frames]
+    noise = rng.standard_normal((frames, channels))
+    return 0.3 * envelope[:, None] * noise
+
+
+def quiet(frames, samplerate, channels, rng):
+    return 0.001 * rng.standard_normal((frames, channels))
+
+
+def white_noise(frames, samplerate, channels, rng):
+    return 0.3 * rng.standard_normal((frames, channels))
+
+
+CLIPS = {
+    'mains hum': hum,
+    'bursts': speech_like,
+    'quiet room': quiet,
+    'white noise': white_noise,
+}
+
+
+def first_block(path):
+    blocks = decode_flac(path)
+    next(blocks)
+    next(blocks)
+    blocks.close()
+
+
+def decode_all(path):
+    for _ in decode_flac(path):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--samplerate', type=int, default=44100)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--subtype', default='PCM_16',
+                        choices=['PCM_16', 'PCM_24'])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frames = int(args.duration * args.samplerate)
+    directory = tempfile.TemporaryDirectory()
+    print('{:<12} {:>10} {:>10} {:>7} {:>12} {:>12} {:>12}'.format(
+        'clip', 'wav bytes', 'flac bytes', 'ratio', 'encode',
+        'first block', 'decode'))
+    for name, generate in CLIPS.items():
+        wav = Path(directory.name) / 'clip.wav'
+        flac = Path(directory.name) / 'clip.flac'
+        data = np.clip(generate(frames, args.samplerate, args.channels, rng),
+                       -1, 1)
+        soundfile.write(str(wav), data, args.samplerate, args.subtype)
+        encode = measure(lambda: encode_flac(wav, flac), args.repeat)
+        wav_size, flac_size = wav.stat().st_size, flac.stat().st_size
+        print('{:<12} {:>10} {:>10} {:>6.2f}x {:>7.1f} MB/s {:>9.2f} ms '
+              '{:>9.2f} ms'.format(
+                  name, wav_size, flac_size, wav_size / flac_size,
+                  wav_size / encode / 1000,
+                  measure(lambda: first_block(flac), args.repeat),
+                  measure(lambda: decode_all(flac), args.repeat)))
+    directory.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Measures GET /record filter queries with and without record indexes.
+
+Usage (from labapp directory):
+
+    DATABASE_URL=... python -m benchmarks.record_indexes --series 20 \
+        --records 50000
+
+Database tables are dropped and created again before seeding.
+"""
+import argparse
+
+from app.helpers import datetime_to_string, time_to_datetime
+from app.labapp_api import filter_records
+from app.models import db, Record
+
+from benchmarks import (
+    create_benchmark_app, explain, measure, reset_database, seed_records
+)
+
+INDEXES = [
+    'ix_record_series_uid_start_time_stop_time',
+    'ix_record_series_uid_uploaded_at',
+    'ix_record_label_uid_start_time',
+    'ix_record_start_time_id',
+]
+PAGE_SIZE = 100
+
+
+def benchmark_queries(series, records_per_series):
+    duration = series.parameters.duration
+    middle = 1.5e9 + records_per_series // 2 * duration
+    recorded_from = datetime_to_string(time_to_datetime(middle))
+    recorded_to = datetime_to_string(time_to_datetime(middle + 600))
+    return {
+        'series': filter_records(series_uid=[series.uid]),
+        'series and time range': filter_records(
+            series_uid=[series.uid], recorded_from=recorded_from,
+            recorded_to=recorded_to
+        ),
+        'series not uploaded': filter_records(series_uid=[series.uid],
+                                              uploaded=False),
+        'label': filter_records(label=['anomaly']),
+        'time range': filter_records(recorded_from=recorded_from,
+                                     recorded_to=recorded_to),
+        'keyset page': filter_records().filter(Record.start_time > middle),
+    }
+
+
+def run(queries, repeat):
+    for name, query in queries.items():
+        page = query.limit(PAGE_SIZE)
+        latency = measure(page.all, repeat)
+        print('  {:<24} {:>10.2f} ms'.format(name, latency))
+        for row in explain(page):
+            print('      ' + ' | '.join(str(c) for c in row))
+
+
+def set_indexes(create):
+    # release session connection, open transaction would block DDL
+    db.session.close()
+    db.engine.dispose()
+    for index in Record.__table__.indexes:
+        if index.name not in INDEXES:
+            continue
+        try:
+            if create:
+                index.create(db.engine)
+            else:
+                index.drop(db.engine)
+        except Exception as ex:
+            print('  index {} left unchanged: {}'.format(index.name, ex))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--series', type=int, default=10)
+    parser.add_argument('--records', type=int, default=20000,
+                        help='records per series')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    create_benchmark_app()
+    reset_database()
+    serieses = seed_records(args.series, args.records)
+    queries = benchmark_queries(serieses[0], args.records)
+
+    print('Without record indexes:')
+    set_indexes(create=False)
+    run(queries, args.repeat)
+    print('With record indexes:')
+    set_indexes(create=True)
+    run(queries, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
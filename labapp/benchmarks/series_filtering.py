@@ -0,0 +1,130 @@
+"""Measures GET /series filtering latency against size of recording
+parameters table, comparing single joined query with former two phase
+implementation (load matching parameters, then OR their uids).
+
+Usage (from labapp directory):
+
+    DATABASE_URL=... python -m benchmarks.series_filtering \
+        --sizes 100 1000 10000 --series 500
+
+Database tables are dropped and created again before seeding.
+"""
+import argparse
+import random
+
+from sqlalchemy import and_, exc, or_
+
+from app.labapp_api import filter_serieses
+from app.models import db, Recorder, RecordingParameters, Series
+
+from benchmarks import create_benchmark_app, measure, reset_database
+
+FILTERS = {
+    'channels': {'channels': [1]},
+    'samplerate and channels': {'samplerate': [44100], 'channels': [1, 2]},
+    'duration': {'duration': [5]},
+}
+
+
+def legacy_get_serieses(samplerate=None, channels=None, duration=None):
+    parameters_filters = []
+    if samplerate:
+        parameters_filters.append(
+            or_(*[RecordingParameters.samplerate == s for s in samplerate])
+        )
+    if channels:
+        parameters_filters.append(
+            or_(*[RecordingParameters.channels == c for c in channels])
+        )
+    if duration:
+        parameters_filters.append(
+            or_(*[RecordingParameters.duration >= d for d in duration])
+        )
+        parameters_filters.append(
+            or_(*[RecordingParameters.duration < d + 1 for d in duration])
+        )
+    parameters = RecordingParameters.query.filter(and_(*parameters_filters))
+    parameters_uids = [p.to_dict()['uid'] for p in parameters]
+    serieses = Series.query.filter(
+        or_(*[Series.parameters_uid == p for p in parameters_uids])
+    )
+    return [s.to_dict() for s in serieses]
+
+
+def get_serieses(**filters):
+    return [s.to_dict() for s in filter_serieses(**filters)]
+
+
+def grow_parameters(size):
+    from app.tests.fact import creators
+
+    count = RecordingParameters.query.count()
+    rows = []
+    for _ in range(count, size):
+        row = creators.create_recording_parameters(
+            samplerate=random.choice([16000, 22050, 44100, 48000]),
+            channels=random.choice([1, 2, 4]),
+            duration=random.choice([1.0, 5.0, 10.0, 60.0])
+        )
+        rows.append(row)
+    if rows:
+        db.session.execute(RecordingParameters.__table__.insert(), rows)
+        db.session.commit()
+    return [uid for uid, in db.session.query(RecordingParameters.uid)]
+
+
+def seed_serieses(count, parameters_uids):
+    from app.tests.fact import creators
+
+    recorder = Recorder(uid='BenchmarkRecorder')
+    db.session.add(recorder)
+    db.session.commit()
+    rows = []
+    for _ in range(count):
+        row = creators.create_series(
+            recorder_uid=recorder.uid,
+            parameters={'uid': random.choice(parameters_uids)}
+        )
+        row['parameters_uid'] = row.pop('parameters')['uid']
+        rows.append(row)
+    db.session.execute(Series.__table__.insert(), rows)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 5000, 20000],
+                        help='sizes of recording parameters table')
+    parser.add_argument('--series', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    create_benchmark_app()
+    reset_database()
+    seed_serieses(args.series, grow_parameters(min(args.sizes)))
+
+    print('{:>10}  {:<24} {:>12} {:>12}'.format(
+        'parameters', 'filter', 'two phase', 'joined'))
+    for size in sorted(args.sizes):
+        grow_parameters(size)
+        for name, filters in FILTERS.items():
+            joined = measure(lambda: get_serieses(**filters), args.repeat)
+            try:
+                assert len(legacy_get_serieses(**filters)) == \
+                    len(get_serieses(**filters))
+                legacy = '{:>9.2f} ms'.format(measure(
+                    lambda: legacy_get_serieses(**filters), args.repeat
+                ))
+            except exc.DBAPIError:
+                # databases limit size of statement, OR of thousands of
+                # uids may not be executed at all
+                legacy = '{:>12}'.format('failed')
+            finally:
+                db.session.remove()
+            print('{:>10}  {:<24} {} {:>9.2f} ms'.format(
+                size, name, legacy, joined))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Measures latency of registering record (POST /record) against number of
+series maintained by recording recorder, comparing lookup of series owner
+with former check hydrating all series of recorder.
+
+Usage (from labapp directory):
+
+    DATABASE_URL=... python -m benchmarks.series_ownership \
+        --sizes 10 100 1000 10000
+
+Database tables are dropped and created again before seeding. Caches are
+cleared before every request, so owner is always queried.
+"""
+import argparse
+import json
+import uuid
+from datetime import datetime
+
+from app.cache import clear_caches
+from app.helpers import encode_recorder_key, get_object
+from app.models import db, Recorder, Series
+
+from benchmarks import create_benchmark_app, measure, reset_database
+
+
+def seed_recorder(series_count):
+    """Creates recorder maintaining given number of series. Returns uid of
+    recorder and of its last series.
+    """
+    from app.tests.fact import models
+
+    recorder = models.RecorderFactory.create()
+    parameters = models.RecordingParametersFactory.create()
+    rows = [{
+        'uid': str(uuid.uuid4()),
+        'created_at': datetime.now(),
+        'description': '',
+        'parameters_uid': parameters.uid,
+        'recorder_uid': recorder.uid
+    } for _ in range(series_count)]
+    db.session.execute(Series.__table__.insert(), rows)
+    db.session.commit()
+    return recorder.uid, rows[-1]['uid']
+
+
+def legacy_check(recorder_uid, series_uid):
+    recorder = get_object(Recorder, recorder_uid)
+    assert series_uid in [s.uid for s in recorder.serieses]
+    db.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_benchmark_app()
+    client = app.test_client()
+    print('{:>8} {:>14} {:>14}'.format('series', 'POST /record',
+                                       'legacy check'))
+    for size in args.sizes:
+        reset_database()
+        recorder_uid, series_uid = seed_recorder(size)
+        headers = {'recorder_key': encode_recorder_key(recorder_uid)}
+        start_time = [1.5e9]
+
+        def register():
+            clear_caches()
+            start_time[0] += 10
+            response = client.post('/1.0/lab/record', headers=headers,
+                                   content_type='application/json',
+                                   data=json.dumps({
+                                       'series_uid': series_uid,
+                                       'start_time': start_time[0],
+                                       'label_uid': None
+                                   }))
+            assert response.status_code == 200, response.data
+
+        print('{:>8} {:>11.2f} ms {:>11.2f} ms'.format(
+            size, measure(register, args.repeat),
+            measure(lambda: legacy_check(recorder_uid, series_uid),
+                    args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
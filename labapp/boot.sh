@@ -5,4 +5,4 @@ while ! mysqladmin ping -h"db" -P"3306" --silent; do
     sleep 1s
 done
 flask db upgrade
-exec gunicorn -w 4 -b :5000 --access-logfile - --error-logfile - wsgi:app
+exec gunicorn -w 4 --threads 4 -b :5000 --access-logfile - --error-logfile - wsgi:app
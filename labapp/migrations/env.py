@@ -3,6 +3,11 @@ from alembic import context
 from sqlalchemy import engine_from_config, pool
 from logging.config import fileConfig
 import logging
+import os
+import sys
+
+# revisions share helpers kept next to this file
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
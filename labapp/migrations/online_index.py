@@ -0,0 +1,36 @@
+"""Helpers of revisions building indexes of record table online: MySQL is
+asked for an in-place build that does not lock the table (the statement
+fails instead of silently falling back to a locking copy), PostgreSQL
+builds them concurrently outside of the migration transaction.
+"""
+from alembic import op
+
+
+def create_index_online(name, columns):
+    dialect = op.get_bind().dialect.name
+    if dialect == 'mysql':
+        op.execute(
+            'ALTER TABLE record ADD INDEX {} ({}), '
+            'ALGORITHM=INPLACE, LOCK=NONE'.format(name, ', '.join(columns))
+        )
+    elif dialect == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.create_index(name, 'record', columns,
+                            postgresql_concurrently=True)
+    else:
+        op.create_index(name, 'record', columns)
+
+
+def drop_index_online(name):
+    dialect = op.get_bind().dialect.name
+    if dialect == 'mysql':
+        op.execute(
+            'ALTER TABLE record DROP INDEX {}, '
+            'ALGORITHM=INPLACE, LOCK=NONE'.format(name)
+        )
+    elif dialect == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index(name, table_name='record',
+                          postgresql_concurrently=True)
+    else:
+        op.drop_index(name, table_name='record')
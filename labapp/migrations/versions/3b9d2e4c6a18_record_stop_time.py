@@ -0,0 +1,73 @@
+"""record stop_time
+
+Revision ID: 3b9d2e4c6a18
+Revises: 7f0e3ae701ad
+Create Date: 2026-10-18 09:12:41.503114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from online_index import create_index_online, drop_index_online
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9d2e4c6a18'
+down_revision = '7f0e3ae701ad'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 10000
+
+record = sa.table(
+    'record',
+    sa.column('id', sa.Integer()),
+    sa.column('series_uid', sa.String(36)),
+    sa.column('start_time', sa.Numeric(17, 7)),
+    sa.column('duration', sa.Numeric(13, 7)),
+    sa.column('stop_time', sa.Numeric(17, 7))
+)
+series = sa.table(
+    'series',
+    sa.column('uid', sa.String(36)),
+    sa.column('parameters_uid', sa.String(36))
+)
+recording_parameters = sa.table(
+    'recording_parameters',
+    sa.column('uid', sa.String(36)),
+    sa.column('duration', sa.Numeric(13, 7))
+)
+
+
+def backfill_records_duration():
+    connection = op.get_bind()
+    first_id, last_id = connection.execute(
+        sa.select([sa.func.min(record.c.id), sa.func.max(record.c.id)])
+    ).first()
+    if first_id is None:
+        return
+    duration = sa.select([recording_parameters.c.duration]).\
+        where(recording_parameters.c.uid == series.c.parameters_uid).\
+        where(series.c.uid == record.c.series_uid).\
+        as_scalar()
+    for batch_start in range(first_id, last_id + 1, BACKFILL_BATCH_SIZE):
+        connection.execute(
+            record.update().
+            where(record.c.id >= batch_start).
+            where(record.c.id < batch_start + BACKFILL_BATCH_SIZE).
+            values(duration=duration,
+                   stop_time=record.c.start_time + duration)
+        )
+
+
+def upgrade():
+    op.add_column('record', sa.Column('duration', sa.Numeric(precision=13, scale=7, asdecimal=False), nullable=True))
+    op.add_column('record', sa.Column('stop_time', sa.Numeric(precision=17, scale=7, asdecimal=False), nullable=True))
+    backfill_records_duration()
+    create_index_online('ix_record_series_uid_start_time_stop_time',
+                        ['series_uid', 'start_time', 'stop_time'])
+
+
+def downgrade():
+    drop_index_online('ix_record_series_uid_start_time_stop_time')
+    op.drop_column('record', 'stop_time')
+    op.drop_column('record', 'duration')
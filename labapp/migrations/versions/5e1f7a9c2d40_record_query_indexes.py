@@ -0,0 +1,33 @@
+"""record query indexes
+
+Revision ID: 5e1f7a9c2d40
+Revises: 3b9d2e4c6a18
+Create Date: 2026-10-18 10:03:27.118452
+
+Indexes are built online, see online_index.
+
+"""
+from online_index import create_index_online, drop_index_online
+
+
+# revision identifiers, used by Alembic.
+revision = '5e1f7a9c2d40'
+down_revision = '3b9d2e4c6a18'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_record_series_uid_uploaded_at', ['series_uid', 'uploaded_at']),
+    ('ix_record_label_uid_start_time', ['label_uid', 'start_time']),
+    ('ix_record_start_time_id', ['start_time', 'id']),
+]
+
+
+def upgrade():
+    for name, columns in INDEXES:
+        create_index_online(name, columns)
+
+
+def downgrade():
+    for name, _ in reversed(INDEXES):
+        drop_index_online(name)
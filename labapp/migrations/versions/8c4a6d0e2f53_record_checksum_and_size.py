@@ -0,0 +1,26 @@
+"""record checksum and size
+
+Revision ID: 8c4a6d0e2f53
+Revises: 5e1f7a9c2d40
+Create Date: 2026-10-18 11:26:05.772940
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4a6d0e2f53'
+down_revision = '5e1f7a9c2d40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('record', sa.Column('checksum', sa.String(length=64), nullable=True))
+    op.add_column('record', sa.Column('size', sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('record', 'size')
+    op.drop_column('record', 'checksum')
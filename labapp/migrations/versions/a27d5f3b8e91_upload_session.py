@@ -0,0 +1,34 @@
+"""upload session
+
+Revision ID: a27d5f3b8e91
+Revises: 8c4a6d0e2f53
+Create Date: 2026-10-18 12:41:50.209316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a27d5f3b8e91'
+down_revision = '8c4a6d0e2f53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('upload_session',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('uid', sa.String(length=36), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('length', sa.BigInteger(), nullable=True),
+    sa.Column('record_uid', sa.String(length=36), nullable=False),
+    sa.ForeignKeyConstraint(['record_uid'], ['record.uid'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('uid')
+    )
+
+
+def downgrade():
+    op.drop_table('upload_session')
@@ -0,0 +1,25 @@
+"""record checksum index
+
+Revision ID: d3f81b6c0a47
+Revises: a27d5f3b8e91
+Create Date: 2026-10-18 14:32:41.506218
+
+Index is built online, see online_index.
+
+"""
+from online_index import create_index_online, drop_index_online
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f81b6c0a47'
+down_revision = 'a27d5f3b8e91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_online('ix_record_checksum', ['checksum'])
+
+
+def downgrade():
+    drop_index_online('ix_record_checksum')
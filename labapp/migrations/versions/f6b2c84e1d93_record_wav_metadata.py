@@ -0,0 +1,26 @@
+"""record wav metadata
+
+Revision ID: f6b2c84e1d93
+Revises: d3f81b6c0a47
+Create Date: 2026-10-18 15:12:09.318647
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6b2c84e1d93'
+down_revision = 'd3f81b6c0a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('record', sa.Column('frames', sa.BigInteger(), nullable=True))
+    op.add_column('record', sa.Column('bit_depth', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('record', 'bit_depth')
+    op.drop_column('record', 'frames')